@@ -1,374 +1,484 @@
+import gc
 import json
+import logging
 import os
-from math import floor
+import queue
+import time
 
-import qrcode
-import requests
-from PIL import Image, ImageFont
-from PIL import ImageDraw
 from uuid import uuid4
 
-from barcode import EAN13, Code128
-from barcode.writer import ImageWriter  # 載入 barcode.writer 的 ImageWriter
-
-from flask import Flask, request, abort, render_template, jsonify, redirect, url_for
-from dotenv import load_dotenv
-from future.backports.datetime import datetime
-from linebot.v3 import (
-    WebhookHandler
+import click
+from flask import (
+    Blueprint, Flask, request, abort, render_template, jsonify, redirect, Response, stream_with_context, g,
+    current_app,
 )
+from dotenv import load_dotenv
 from linebot.v3.exceptions import (
     InvalidSignatureError
 )
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage, TemplateMessage, ButtonsTemplate, MessageAction, URIAction, ImageMessage, PostbackAction, FlexMessage,
-    FlexCarousel
-)
 from linebot.v3.webhooks import (
     MessageEvent,
     TextMessageContent, PostbackEvent
 )
-from pillow_heif import register_heif_opener
-
-from template import flex
 
-app = Flask(__name__, static_folder='static')
+# 各模組在 import 時讀取環境變數，必須先載入 .env
 load_dotenv()
 
-configuration = Configuration(access_token=os.environ.get('LINE_CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.environ.get('LINE_CHANNEL_SECRET'))
-register_heif_opener()
+import assets  # noqa: E402
+import auth  # noqa: E402
+import catalog  # noqa: E402
+import db  # noqa: E402
+import metrics  # noqa: E402
+import orders  # noqa: E402
+import storage  # noqa: E402
+import tracing  # noqa: E402
+import users  # noqa: E402
+from webhook import QueuedWebhookHandler  # noqa: E402
+
+# PIL / pillow_heif / qrcode / barcode 與 LINE SDK 的 messaging 模組載入很慢，
+# 只在用到的地方才 import；uwsgi 則由 master 在 fork 之前透過 preload() 先載入
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+bp = Blueprint('bot', __name__, cli_group=None)
+handler = QueuedWebhookHandler(os.environ.get('LINE_CHANNEL_SECRET'))
+
+
+def create_app():
+    tracing.configure_logging()
+
+    app = Flask(__name__, static_folder='static')
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    app.before_request(start_request)
+    app.after_request(record_request)
+    app.after_request(cache_static)
+    app.register_blueprint(bp)
+    return app
+
+
+def preload():
+    """Import the heavy modules and load the card assets once, before uwsgi forks its workers."""
+    import card
+    import images  # noqa: F401
+    import line_api  # noqa: F401
+    import notify  # noqa: F401
+    import replies  # noqa: F401
+    import requests  # noqa: F401
+
+    try:
+        card.get_context()
+    except OSError:
+        logging.getLogger(__name__).warning('Card template or font is missing, cards will load them on demand')
+    # 之後產生的物件才交給 GC 追蹤，避免 GC 掃描時寫入共用的 page 而失去 copy-on-write 的效果
+    gc.freeze()
+
+
+def start_request():
+    g.start = time.perf_counter()
+    tracing.start(request.headers.get('X-Request-Id'))
 
 
-@app.route("/callback", methods=['POST'])
+def record_request(response):
+    endpoint = request.endpoint or 'not_found'
+    metrics.observe('http_request_seconds', time.perf_counter() - g.start, endpoint=endpoint)
+    metrics.inc('http_requests_total', endpoint=endpoint, status=str(response.status_code))
+    response.headers['X-Request-Id'] = tracing.current()
+    return response
+
+
+def cache_static(response):
+    if request.endpoint == 'static':
+        return assets.cache_static(request, response, current_app.static_folder, request.view_args['filename'])
+    return response
+
+
+@bp.route("/callback", methods=['POST'])
 def callback():
     # get X-Line-Signature header value
-    signature = request.headers['X-Line-Signature']
+    signature = request.headers.get('X-Line-Signature')
+    if signature is None:
+        abort(400)
 
     # get request body as text
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    current_app.logger.debug("Request body: %d bytes", len(body))
+    metrics.observe('webhook_body_bytes', len(body), buckets=metrics.SIZE_BUCKETS)
 
-    # handle webhook body
+    # 驗證簽章後排入背景 thread 處理，立刻回 200 給 LINE
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
-        app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
+        current_app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
+    except queue.Full:
+        current_app.logger.warning("Webhook queue is full, asking LINE to redeliver later")
+        abort(503)
 
     return 'OK'
 
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TemplateMessage(
-                        alt_text='功能表',
-                        template=ButtonsTemplate(
-                            text='請選擇服務項目',
-                            actions=[
-                                PostbackAction(
-                                    label='會員卡',
-                                    displayText='顯示會員卡',
-                                    data='action=member_card'
-                                ),
-                            ]
-                        )
-                    ),
-                    FlexMessage(
-                        alt_text='功能表',
-                        contents=FlexCarousel.from_json(flex)
-                    )
-                ]
-            )
+    import line_api
+    import replies
+    from linebot.v3.messaging import ReplyMessageRequest
+
+    line_bot_api = line_api.messaging_api()
+
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=replies.text_message_replies(event)
         )
+    )
 
 
 @handler.add(PostbackEvent)
 def handle_postback(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        if event.postback.data == 'action=member_card':
-            if os.path.exists('static/users.json'):
-                users = json.load(open('static/users.json'))
-            else:
-                users = []
-
-            userId = event.source.user_id
-            user_info = list(filter(lambda x: x["id"] == userId, users))
-
-            if len(user_info) == 0:
-                user_info = {
-                    "id": userId,
-                    "name": "未提供",
-                }
-                users.append(user_info)
-                with open("static/users.json", "w") as f:
-                    json.dump(users, f)
-            else:
-                user_info = user_info[0]
-            gen_member_card(user_info["name"], userId)
-            uid = userId
-
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[
-                        ImageMessage(
-                            original_content_url=f"https://test-linebot.hsuan.app/static/card/{uid}.png",
-                            preview_image_url=f"https://test-linebot.hsuan.app/static/card/{uid}.png"
-                        ),
-                        ImageMessage(
-                            original_content_url=f"https://test-linebot.hsuan.app/static/card/{uid}_qr.png",
-                            preview_image_url=f"https://test-linebot.hsuan.app/static/card/{uid}_qr.png"
-                        )
-                    ]
-                )
-            )
-
-
-def gen_member_card(name, uid):
-    # Open an Image
-    img = Image.open("static/card.png")
-
-    if not os.path.exists("static/card"):
-        os.makedirs("static/card")
-
-    qr = qrcode.make(uid, border=1)
-    qr.save(f"static/card/{uid}_qr.png")
-
-    barcode = Code128(uid[1:].zfill(12), writer=ImageWriter())
-    barcode.save(f"static/card/{uid}_barcode")
-
-    avatar_path = f"static/avatar/{uid}"
-    if os.path.exists(avatar_path):
-        avatar = Image.open(f"static/avatar/{uid}", formats=["png", "jpeg"])
-    else:
-        avatar = Image.open("static/avatar/default.png")
-    base_width = 800
-    wpercent = (base_width / float(avatar.size[0]))
-    hsize = int((float(avatar.size[1]) * float(wpercent)))
-    avatar = avatar.resize((800, hsize))
-    img.paste(avatar, (300, 600))
+    import line_api
+    import replies
+    from linebot.v3.messaging import ReplyMessageRequest
 
-    # Call draw Method to add 2D graphics in an image
-    I1 = ImageDraw.Draw(img)
-    # Add Text to an image
-    I1.text((1800, 860), name, fill=(0, 0, 0), font=ImageFont.truetype('static/font.ttf', 64))
-    I1.text((1800, 980), uid, fill=(0, 0, 0), font=ImageFont.truetype('static/font.ttf', 64))
-    I1.text((1800, 1100), "綠星會員", fill=(0, 0, 0), font=ImageFont.truetype('static/font.ttf', 64))
+    messages = replies.postback_replies(event)
+    if messages is None:
+        return
 
-    # Resize the QR code
-    qr = qr.resize((400, 400))
-    # Paste the QR code into the image
-    img.paste(qr, (2400, 1300))
+    line_bot_api = line_api.messaging_api()
 
-    barcode = Image.open(f"static/card/{uid}_barcode.png")
-    img.paste(barcode, (1250, 1300))
-
-    # Save the edited image
-    img.save(f"static/card/{uid}.png")
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=messages
+        )
+    )
 
 
-@app.get('/api/admin/items')
+@bp.get('/api/admin/items')
 def item_api_index():
-    if not os.path.exists("static/item.json"):
-        with open("static/item.json", "w") as f:
-            f.write("[]")
+    return jsonify(catalog.get_catalog().items)
 
-    items = json.load(open("static/item.json"))
-    return jsonify(items)
 
-
-@app.get('/profile')
+@bp.get('/profile')
 def profile():
     return render_template('profile.html')
 
 
-@app.post('/api/admin/orders')
+def json_body():
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+@bp.post('/api/admin/orders')
 def order_api_create():
-    if not os.path.exists("static/order.json"):
-        with open("static/order.json", "w") as f:
-            f.write("[]")
-
-    if not os.path.exists("static/point.json"):
-        with open("static/point.json", "w") as f:
-            f.write("[]")
-
-    orders = json.load(open("static/order.json"))
-    points = json.load(open("static/point.json"))
-
-    order_id = str(uuid4())
-    orders.append({
-        "id": order_id,
-        "user_id": request.json["userId"],
-        "items": request.json["items"],
-        "total": request.json["total"],
-    })
+    # 總金額由伺服器依商品價格重新計算；同一個 Idempotency-Key 重送時回傳第一次建立的訂單
+    data = json_body()
+    try:
+        order = orders.create_order(data.get("userId"), data.get("items"), data.get("total"),
+                                    idempotency_key=request.headers.get("Idempotency-Key"))
+    except orders.InvalidOrder:
+        abort(400)
+    except db.IdempotencyConflict:
+        abort(422)
 
-    point_record_id = str(uuid4())
-    points.append({
-        "id": point_record_id,
-        "user_id": request.json["userId"],
-        "description": f"消費 {request.json['total']} 元，獲得 {floor(request.json['total'] / 10)} 點",
-        "order_id": order_id,
-        "point": floor(request.json["total"] / 10),
-        "created_at": datetime.now().isoformat(),
-    })
+    return jsonify(order), 201
+
+
+@bp.post('/api/admin/orders/bulk')
+def order_api_bulk_create():
+    data = json_body()
+    try:
+        created = orders.create_orders(data.get("orders"), idempotency_key=request.headers.get("Idempotency-Key"))
+    except orders.InvalidOrder as e:
+        return jsonify({"error": str(e)}), 400
+    except db.IdempotencyConflict:
+        abort(422)
 
-    with open("static/order.json", "w") as f:
-        json.dump(orders, f)
+    return jsonify({"orders": created}), 201
 
-    with open("static/point.json", "w") as f:
-        json.dump(points, f)
 
-    return jsonify(orders)
+def verify(token):
+    try:
+        return auth.verify_id_token(token)
+    except auth.InvalidIdToken:
+        abort(401)
+    except auth.VerifyUnavailable:
+        # verify API 逾時或連不上時請前端稍後再試，不要當成登入失效
+        abort(503)
+
 
+def page_args():
+    # 跟 async_app 一樣，參數不是整數時回 400，不要默默換成預設值
+    try:
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+        before = int(request.args["cursor"]) if "cursor" in request.args else None
+    except ValueError:
+        abort(400)
+    return orders.clamp_limit(limit), before
 
-@app.get('/api/admin/orders')
+
+@bp.get('/api/admin/orders')
 def order_api_index():
-    if not os.path.exists("static/order.json"):
-        with open("static/order.json", "w") as f:
-            f.write("[]")
+    filters = {
+        "user_id": request.args.get("user_id"),
+        "since": request.args.get("from"),
+        "until": request.args.get("to"),
+    }
+    items = catalog.get_catalog()
+
+    if request.args.get("format") == "ndjson":
+        # 匯出用：逐筆輸出，不把全部訂單讀進記憶體
+        def generate():
+            for order in db.iter_orders(**filters):
+                yield json.dumps(orders.join_order_items(order, items), ensure_ascii=False) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    limit, before = page_args()
+    order_page, next_cursor = db.page_orders(limit, before=before, **filters)
+    for order in order_page:
+        orders.join_order_items(order, items)
+
+    return jsonify({
+        "orders": order_page,
+        "next_cursor": next_cursor,
+    })
+
+
+@bp.get('/api/admin/sales/daily')
+def sales_daily_index():
+    return jsonify({
+        "today": orders.business_day(),
+        "days": db.sales_daily(request.args.get("from"), request.args.get("to")),
+    })
 
-    orders = json.load(open("static/order.json"))
-    items = json.load(open("static/item.json"))
 
-    # inner join name, price
-    for order in orders:
-        order["items"] = list(map(lambda x: {
-            "id": x["id"],
-            "qty": x["qty"],
-            "name": filter(lambda z: z["id"] == x["id"], items).__next__()["name"],
-            "price": filter(lambda z: z["id"] == x["id"], items).__next__()["price"],
-        }, order["items"]))
+@bp.get('/api/admin/sales/items')
+def sales_items_index():
+    rows = db.sales_items(request.args.get("from"), request.args.get("to"))
+    return jsonify({"items": orders.join_sales_items(rows, catalog.get_catalog())})
 
-    # for order in orders:
-    #     order["items"] = json.load(open("static/item.json"))
-    #     order["items"] = list(filter(lambda x: x["id"] in order["items"], order["items"]))
 
-    return jsonify(orders)
+@bp.get('/api/admin/sales/members')
+def sales_members_index():
+    limit, _ = page_args()
+    return jsonify({"members": db.sales_members(limit, request.args.get("user_id"))})
 
 
-@app.post('/admin/items')
+@bp.post('/admin/items')
 def item_create():
-    if not os.path.exists("static/item.json"):
-        with open("static/item.json", "w") as f:
-            f.write("[]")
+    import images
+
+    price = request.form.get("price", type=int)
+    if price is None or price < 0:
+        abort(400)
 
-    items = json.load(open("static/item.json"))
     item_id = str(uuid4())
 
-    request.files["image"].save(f"static/item/{item_id}.png")
+    try:
+        images.save_item(request.files["image"].stream,
+                         storage.path('item', item_id, '.jpg'), storage.path('item', item_id, '_thumb.jpg'))
+    except images.InvalidImage:
+        abort(400)
 
-    items.append({
+    db.create_item({
         "id": item_id,
         "name": request.form["name"],
-        "image": f"https://test-linebot.hsuan.app/static/item/{item_id}.png",
-        "price": request.form["price"],
+        "image": storage.url('item', item_id, '.jpg'),
+        "thumbnail": storage.url('item', item_id, '_thumb.jpg'),
+        "price": price,
     })
 
-    with open("static/item.json", "w") as f:
-        json.dump(items, f)
-
     return redirect("https://test-linebot.hsuan.app/admin/items")
 
 
-@app.get('/api/points')
+@bp.get('/api/points')
 def point_index():
-    if not os.path.exists("static/point.json"):
-        with open("static/point.json", "w") as f:
-            f.write("[]")
-
-    if not os.path.exists("static/users.json"):
-        with open("static/users.json", "w") as f:
-            f.write("[]")
-
-    points = json.load(open("static/point.json"))
-    users = json.load(open("static/users.json"))
-
-    userId = request.headers.get("Authorization")
-    userId = userId.replace("Bearer ", "")
-    user_info = requests.post("https://api.line.me/oauth2/v2.1/verify", data={
-        "id_token": userId,
-        "client_id": os.environ.get("LINE_CHANNEL_ID"),
-    }).json()
+    user_info = verify(request.headers.get("Authorization", "").replace("Bearer ", ""))
     userId = user_info["sub"]
 
-    user_db_info = list(filter(lambda x: x["id"] == userId, users))
-    if len(user_db_info) == 0:
-        users.append({
-            "id": userId,
-            "name": user_info["name"],
-        })
-        with open("static/users.json", "w") as f:
-            json.dump(users, f)
+    users.sync_name(userId, user_info["name"])
 
-    points = list(filter(lambda x: x["user_id"] == userId, points))
+    limit, before = page_args()
+    points, next_cursor = db.page_points(userId, limit, before=before)
+    return jsonify({
+        "points": points,
+        "next_cursor": next_cursor,
+    })
 
-    return jsonify(points)
 
+@bp.get('/api/points/balance')
+def point_balance():
+    user_info = verify(request.headers.get("Authorization", "").replace("Bearer ", ""))
 
-@app.post('/profile/avatar')
-def upload_avatar():
-    if not os.path.exists("static/avatar"):
-        os.makedirs("static/avatar")
+    return jsonify({
+        "user_id": user_info["sub"],
+        "balance": db.get_balance(user_info["sub"]),
+    })
+
+
+@bp.get('/api/profile')
+def profile_api():
+    import card
+
+    user_info = verify(request.headers.get("Authorization", "").replace("Bearer ", ""))
 
-    if not os.path.exists("static/users.json"):
-        with open("static/users.json", "w") as f:
-            f.write("[]")
+    # 會員卡可能被快取淘汰了，結帳時要掃 QR code，先重新產生
+    card.wait_for_card(user_info["name"], user_info["sub"])
+    return jsonify(card.profile_urls(user_info["sub"]))
 
-    users = json.load(open("static/users.json"))
 
-    userId = request.form.get('token')
-    user_info = requests.post("https://api.line.me/oauth2/v2.1/verify", data={
-        "id_token": userId,
-        "client_id": os.environ.get("LINE_CHANNEL_ID"),
-    }).json()
-    print(user_info)
+@bp.post('/profile/avatar')
+def upload_avatar():
+    import card
+    import images
+
+    user_info = verify(request.form.get('token'))
     userId = user_info["sub"]
 
-    user_db = list(filter(lambda x: x["id"] == userId, users))
-    if len(user_db) == 0:
-        user_info = {
-            "id": userId,
-            "name": user_info["name"],
-        }
-        users.append(user_info)
-        with open("static/users.json", "w") as f:
-            json.dump(users, f)
-    else:
-        user_info = user_db[0]
+    user = users.sync_name(userId, user_info["name"])
 
-    request.files["avatar"].save(f"static/avatar/{userId}")
-    gen_member_card(user_info["name"], userId)
+    # 上傳時就轉正、轉檔並縮成會員卡使用的大小，產生會員卡時不必再處理
+    try:
+        images.save_avatar(request.files["avatar"].stream, storage.path('avatar', userId))
+    except images.InvalidImage:
+        abort(400)
+    card.ensure_card(user.name, userId)
     return redirect("https://test-linebot.hsuan.app/")
 
 
-@app.get('/')
+@bp.get('/metrics')
+def metrics_index():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.get('/')
 def index():
     return render_template('index.html')
 
 
-@app.get('/admin')
+@bp.get('/admin')
 def admin():
     return render_template('admin.html')
 
 
-@app.get('/admin/items')
+@bp.get('/admin/items')
 def item_index():
     return render_template('manage/items.html')
 
 
+@bp.cli.command('migrate-json')
+def migrate_json():
+    """Import static/*.json into the database (safe to run more than once)."""
+    result = db.migrate_json('static')
+    print(f"migrated {result['users']} users, {result['items']} items, "
+          f"{result['orders']} orders, {result['points']} point records")
+
+
+@bp.cli.command('points-rebuild')
+def points_rebuild():
+    """Recompute every member's point balance from the point ledger."""
+    print(f"rebuilt {db.rebuild_balances()} balances")
+
+
+@bp.cli.command('points-verify')
+def points_verify():
+    """Compare stored point balances with the point ledger and report drift."""
+    drift = db.verify_balances()
+    for user_id, ledger_total, balance in drift:
+        print(f"{user_id}: ledger {ledger_total}, balance {balance}")
+    if drift:
+        raise SystemExit(f"{len(drift)} balances differ from the ledger, run `flask points-rebuild`")
+    print("all balances match the ledger")
+
+
+@bp.cli.command('sales-rebuild')
+def sales_rebuild():
+    """Recompute the per-day, per-item and per-member sales rollups from the order history."""
+    print(f"rolled up {db.rebuild_sales()} orders")
+
+
+@bp.cli.command('storage-migrate')
+@click.option('--dry-run', is_flag=True, help='Only report what would be moved.')
+def storage_migrate(dry_run):
+    """Move avatars, cards and item images from the flat static/ layout into hashed subdirectories."""
+    moved = storage.migrate(dry_run)
+    updates = []
+    for item in db.list_items():
+        image, thumbnail = storage.migrate_url(item["image"]), storage.migrate_url(item["thumbnail"])
+        if (image, thumbnail) != (item["image"], item["thumbnail"]):
+            updates.append((item["id"], image, thumbnail))
+    if updates and not dry_run:
+        db.update_item_images(updates)
+    print(f"moved {moved['avatar']} avatars, {moved['card']} card files, {moved['item']} item images; "
+          f"rewrote {len(updates)} item URLs" + (" (dry run)" if dry_run else ""))
+
+
+@bp.cli.command('storage-janitor')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be deleted.')
+def storage_janitor(dry_run):
+    """Delete QR / barcode intermediates left without a member card, and stale temporary files."""
+    removed = storage.janitor(dry_run=dry_run)
+    for file_path in removed:
+        print(file_path)
+    print(f"{'would remove' if dry_run else 'removed'} {len(removed)} files")
+
+
+@bp.cli.command('db-compact')
+@click.option('--vacuum/--no-vacuum', default=None,
+              help='Force or skip VACUUM; by default it runs only when enough pages are free.')
+def db_compact(vacuum):
+    """Checkpoint and truncate the SQLite WAL, vacuuming the database when it has many free pages."""
+    stats = db.compact(vacuum)
+    if stats["busy"]:
+        print("checkpoint could not finish because of active readers; run it again later")
+    print(f"database {stats['db_bytes_before']} -> {stats['db_bytes']} bytes, "
+          f"wal {stats['wal_bytes_before']} -> {stats['wal_bytes']} bytes, "
+          f"{stats['free_pages']}/{stats['page_count']} pages were free, "
+          f"{'vacuumed' if stats['vacuumed'] else 'not vacuumed'}")
+
+
+@bp.cli.command('cards-issue')
+@click.option('--workers', type=int, help='Render processes, defaults to every core.')
+@click.option('--force', is_flag=True, help='Re-render cards whose inputs have not changed.')
+@click.option('--users-file', type=click.File(), help="CSV of user_id,name to issue instead of every member.")
+def cards_issue(workers, force, users_file):
+    """Render member cards for every member in parallel, e.g. after the card template changes."""
+    import csv
+    import resource
+
+    import card
+
+    if users_file:
+        members = ((row[1], row[0]) for row in csv.reader(users_file) if len(row) >= 2)
+    else:
+        members = ((user["name"], user["id"]) for user in db.iter_users())
+
+    start = time.perf_counter()
+    last_report = [start]
+
+    def progress(rendered):
+        now = time.perf_counter()
+        if now - last_report[0] >= 5:
+            last_report[0] = now
+            print(f"{rendered} cards, {rendered / (now - start):.1f} cards/s")
+
+    rendered, failed = card.render_batch(members, workers=workers, force=force, progress=progress)
+    elapsed = time.perf_counter() - start
+    for uid, error in failed:
+        print(f"{uid}: {error}")
+    # ru_maxrss 單位是 KB；子行程的數值要等它們結束後才算得到
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(f"rendered {rendered} cards in {elapsed:.1f}s ({rendered / elapsed if elapsed else 0:.1f} cards/s), "
+          f"{len(failed)} failed, peak rss {peak_self // 1024}MB main / {peak_worker // 1024}MB per worker")
+
+
+@bp.cli.command('notify-worker')
+def notify_worker():
+    """Send queued push / multicast notifications until interrupted."""
+    import notify
+
+    notify.Notifier().run_forever()
+
+
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
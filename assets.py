@@ -0,0 +1,75 @@
+import hashlib
+import os
+import threading
+
+ASSET_HOST = os.environ.get('ASSET_HOST', 'https://test-linebot.hsuan.app')
+# 設定後 static 檔案交給 nginx 傳送 (X-Accel-Redirect)，例如 /_static/ 對應到 internal location
+STATIC_ACCEL_PREFIX = os.environ.get('STATIC_ACCEL_PREFIX')
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# 每個會員的頭像與會員卡都會算一次雜湊，超過上限就丟掉最早的
+ASSET_DIGEST_CACHE_SIZE = int(os.environ.get('ASSET_DIGEST_CACHE_SIZE', 4096))
+
+_digests = {}
+_lock = threading.Lock()
+
+
+def digest(path):
+    """Return a short SHA-256 of the file content, recomputed only when its mtime / size change."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = (st.st_mtime_ns, st.st_size)
+
+    with _lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    value = h.hexdigest()[:16]
+    with _lock:
+        _digests.pop(path, None)
+        while len(_digests) >= ASSET_DIGEST_CACHE_SIZE:
+            del _digests[next(iter(_digests))]
+        _digests[path] = (signature, value)
+    return value
+
+
+def versioned_url(path):
+    # 內容改變時網址跟著改變，LINE 與瀏覽器就能放心長期快取
+    version = digest(path)
+    if version is None:
+        return f"{ASSET_HOST}/{path}"
+    return f"{ASSET_HOST}/{path}?v={version}"
+
+
+def cache_static(request, response, static_folder, filename):
+    """Add content-hash ETags and Cache-Control to a static file response."""
+    path = os.path.join(static_folder, filename)
+    version = digest(path)
+    if version is None or response.status_code not in (200, 304):
+        return response
+
+    if request.args.get('v') == version:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # 同一個網址的檔案可能被重新產生，每次都要用 ETag 確認
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+
+    response.set_etag(version)
+    response.make_conditional(request)
+
+    if STATIC_ACCEL_PREFIX and response.status_code == 200:
+        response.headers['X-Accel-Redirect'] = STATIC_ACCEL_PREFIX.rstrip('/') + '/' + filename
+        response.close()
+        response.set_data(b'')
+        response.headers.pop('Content-Length', None)
+    return response
@@ -0,0 +1,366 @@
+# asyncio 版本的 bot server，提供 /callback 與 /api/*，適合大量 webhook 同時進來的情境
+#
+#   python async_app.py   (PORT 預設 8080)
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, ApiException, ReplyMessageRequest
+from linebot.v3.webhooks import MessageEvent, TextMessageContent, PostbackEvent
+
+# 各模組在 import 時讀取環境變數，必須先載入 .env
+load_dotenv()
+
+import auth  # noqa: E402
+import catalog  # noqa: E402
+import db  # noqa: E402
+import line_api  # noqa: E402
+import metrics  # noqa: E402
+import orders  # noqa: E402
+import replies  # noqa: E402
+import tracing  # noqa: E402
+import users  # noqa: E402
+
+ASYNC_MAX_PENDING_EVENTS = int(os.environ.get('ASYNC_MAX_PENDING_EVENTS', 256))
+ASYNC_LINE_API_POOL_SIZE = int(os.environ.get('ASYNC_LINE_API_POOL_SIZE', 100))
+REPLY_TIMEOUT = aiohttp.ClientTimeout(total=10, sock_connect=3.05)
+VERIFY_TIMEOUT = aiohttp.ClientTimeout(total=5, sock_connect=3.05)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+parser = WebhookParser(os.environ.get('LINE_CHANNEL_SECRET'))
+
+# SQLite 連線綁在 thread 上，資料庫操作 (以及會碰到資料庫的會員卡排程) 都交給同一條 thread
+db_executor = ThreadPoolExecutor(max_workers=1)
+
+
+async def run_db(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+
+async def reply(app, reply_token, messages):
+    api = app['messaging_api']
+    for attempt in range(4):
+        status = 'error'
+        start = time.perf_counter()
+        try:
+            await api.reply_message_with_http_info(
+                ReplyMessageRequest(reply_token=reply_token, messages=messages),
+                _request_timeout=REPLY_TIMEOUT,
+            )
+            status = '200'
+            return
+        except ApiException as e:
+            status = str(e.status)
+            if e.status not in RETRY_STATUS or attempt == 3:
+                raise
+        finally:
+            metrics.observe('line_api_seconds', time.perf_counter() - start, method='reply_message')
+            metrics.inc('line_api_requests_total', method='reply_message', status=status)
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+async def handle_event(app, event):
+    start = time.perf_counter()
+    try:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            # 商品目錄會查資料庫，也跟 postback 一樣交給資料庫 thread
+            await reply(app, event.reply_token, await run_db(replies.text_message_replies, event))
+        elif isinstance(event, PostbackEvent):
+            messages = await run_db(replies.postback_replies, event)
+            if messages is not None:
+                await reply(app, event.reply_token, messages)
+    except Exception:
+        logger.exception('Failed to handle webhook event %s', event.webhook_event_id)
+    finally:
+        metrics.observe('webhook_event_seconds', time.perf_counter() - start, type=event.type)
+
+
+@web.middleware
+async def instrument(request, handler):
+    start = time.perf_counter()
+    trace_id = tracing.start(request.headers.get('X-Request-Id'))
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else 'not_found'
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, status=str(status))
+    response.headers['X-Request-Id'] = trace_id
+    return response
+
+
+async def metrics_index(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+async def callback(request):
+    signature = request.headers.get('X-Line-Signature')
+    if signature is None:
+        raise web.HTTPBadRequest()
+
+    body = await request.text()
+    metrics.observe('webhook_body_bytes', len(body), buckets=metrics.SIZE_BUCKETS)
+    try:
+        payload = parser.parse(body, signature, as_payload=True)
+    except InvalidSignatureError:
+        logger.info("Invalid signature. Please check your channel access token/channel secret.")
+        raise web.HTTPBadRequest()
+
+    pending = request.app['pending']
+    if len(pending) + len(payload.events) > ASYNC_MAX_PENDING_EVENTS:
+        metrics.inc('webhook_rejected_total')
+        raise web.HTTPServiceUnavailable()
+
+    for event in payload.events:
+        if not await run_db(db.mark_webhook_event, event.webhook_event_id):
+            metrics.inc('webhook_duplicates_total', redelivery=str(event.delivery_context.is_redelivery).lower())
+            continue
+        task = asyncio.create_task(handle_event(request.app, event))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    return web.Response(text='OK')
+
+
+async def verify(request, token):
+    if not token:
+        raise web.HTTPUnauthorized()
+    claims = auth.lookup(token)
+    if claims is not None:
+        return claims
+
+    start = time.perf_counter()
+    try:
+        claims = auth.verify_locally(token)
+    except auth.InvalidIdToken:
+        raise web.HTTPUnauthorized()
+
+    if claims is not None:
+        metrics.observe('token_verify_seconds', time.perf_counter() - start, method='local')
+    else:
+        try:
+            async with request.app['http'].post(auth.VERIFY_URL, data={
+                "id_token": token,
+                "client_id": os.environ.get("LINE_CHANNEL_ID"),
+            }, timeout=VERIFY_TIMEOUT) as response:
+                # 5xx 是 LINE 那邊的問題，不代表 token 無效
+                if response.status >= 500:
+                    raise auth.VerifyUnavailable(f"verify API returned {response.status}")
+                if response.status != 200:
+                    raise web.HTTPUnauthorized()
+                claims = await response.json(content_type=None)
+            if not isinstance(claims, dict):
+                raise auth.VerifyUnavailable('verify API returned a body that is not an object')
+        except (auth.VerifyUnavailable, aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            # verify API 逾時或連不上時請前端稍後再試，不要當成登入失效
+            metrics.inc('token_verify_failures_total', method='remote')
+            raise web.HTTPServiceUnavailable()
+        finally:
+            metrics.observe('token_verify_seconds', time.perf_counter() - start, method='remote')
+
+    auth.remember(token, claims)
+    return claims
+
+
+def bearer_token(request):
+    return request.headers.get("Authorization", "").replace("Bearer ", "")
+
+
+def page_args(request):
+    try:
+        limit = int(request.query["limit"]) if "limit" in request.query else None
+        before = int(request.query["cursor"]) if "cursor" in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+    return orders.clamp_limit(limit), before
+
+
+async def item_api_index(request):
+    items = await run_db(catalog.get_catalog)
+    return web.json_response(items.items)
+
+
+async def json_body(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def order_api_create(request):
+    data = await json_body(request)
+    try:
+        order = await run_db(orders.create_order, data.get("userId"), data.get("items"), data.get("total"),
+                             idempotency_key=request.headers.get("Idempotency-Key"))
+    except orders.InvalidOrder:
+        raise web.HTTPBadRequest()
+    except db.IdempotencyConflict:
+        raise web.HTTPUnprocessableEntity()
+    return web.json_response(order, status=201)
+
+
+async def order_api_bulk_create(request):
+    data = await json_body(request)
+    try:
+        created = await run_db(orders.create_orders, data.get("orders"),
+                               idempotency_key=request.headers.get("Idempotency-Key"))
+    except orders.InvalidOrder as e:
+        return web.json_response({"error": str(e)}, status=400)
+    except db.IdempotencyConflict:
+        raise web.HTTPUnprocessableEntity()
+    return web.json_response({"orders": created}, status=201)
+
+
+def _order_page(limit, before, filters):
+    items = catalog.get_catalog()
+    order_page, next_cursor = db.page_orders(limit, before=before, **filters)
+    return [orders.join_order_items(order, items) for order in order_page], next_cursor
+
+
+def _order_batch(iterator, items, size=500):
+    lines = []
+    for order in iterator:
+        lines.append(json.dumps(orders.join_order_items(order, items), ensure_ascii=False) + "\n")
+        if len(lines) >= size:
+            break
+    return "".join(lines)
+
+
+async def order_api_index(request):
+    filters = {
+        "user_id": request.query.get("user_id"),
+        "since": request.query.get("from"),
+        "until": request.query.get("to"),
+    }
+
+    if request.query.get("format") == "ndjson":
+        # 匯出用：每次從資料庫 thread 取一批，不把全部訂單讀進記憶體
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        items = await run_db(catalog.get_catalog)
+        iterator = await run_db(db.iter_orders, **filters)
+        while True:
+            chunk = await run_db(_order_batch, iterator, items)
+            if not chunk:
+                break
+            await response.write(chunk.encode())
+        await response.write_eof()
+        return response
+
+    limit, before = page_args(request)
+    order_page, next_cursor = await run_db(_order_page, limit, before, filters)
+    return web.json_response({
+        "orders": order_page,
+        "next_cursor": next_cursor,
+    })
+
+
+async def sales_daily_index(request):
+    days = await run_db(db.sales_daily, request.query.get("from"), request.query.get("to"))
+    return web.json_response({"today": orders.business_day(), "days": days})
+
+
+async def sales_items_index(request):
+    rows = await run_db(db.sales_items, request.query.get("from"), request.query.get("to"))
+    items = await run_db(catalog.get_catalog)
+    return web.json_response({"items": orders.join_sales_items(rows, items)})
+
+
+async def sales_members_index(request):
+    limit, _ = page_args(request)
+    members = await run_db(db.sales_members, limit, request.query.get("user_id"))
+    return web.json_response({"members": members})
+
+
+async def point_index(request):
+    user_info = await verify(request, bearer_token(request))
+    limit, before = page_args(request)
+
+    await run_db(users.sync_name, user_info["sub"], user_info["name"])
+    points, next_cursor = await run_db(db.page_points, user_info["sub"], limit, before=before)
+    return web.json_response({
+        "points": points,
+        "next_cursor": next_cursor,
+    })
+
+
+async def point_balance(request):
+    user_info = await verify(request, bearer_token(request))
+    return web.json_response({
+        "user_id": user_info["sub"],
+        "balance": await run_db(db.get_balance, user_info["sub"]),
+    })
+
+
+async def profile_api(request):
+    import card
+
+    user_info = await verify(request, bearer_token(request))
+    uid = user_info["sub"]
+    # 會員卡可能被快取淘汰了，結帳時要掃 QR code，先重新產生；等待時不佔住資料庫 thread
+    if not await run_db(card.card_ready, uid):
+        future = await run_db(card.ensure_card, user_info["name"], uid)
+        if future is not None:
+            done, _ = await asyncio.wait([asyncio.wrap_future(future)], timeout=card.PROFILE_RENDER_TIMEOUT)
+            if done and future.exception() is not None:
+                logger.warning('Card render for %s failed: %r', uid, future.exception())
+    # 要 stat 與雜湊檔案，不在 event loop 上做
+    return web.json_response(await run_db(card.profile_urls, uid))
+
+
+async def on_startup(app):
+    config = line_api.configuration()
+    # 一個 event loop 同時送出的請求遠多於 uwsgi thread，連線池也要跟著放大
+    config.connection_pool_maxsize = ASYNC_LINE_API_POOL_SIZE
+    app['api_client'] = AsyncApiClient(config)
+    app['http'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_LINE_API_POOL_SIZE))
+    app['messaging_api'] = AsyncMessagingApi(app['api_client'])
+    app['pending'] = set()
+
+
+async def on_cleanup(app):
+    if app['pending']:
+        await asyncio.wait(app['pending'], timeout=10)
+    await app['api_client'].close()
+    await app['http'].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[instrument])
+    app.router.add_post('/callback', callback)
+    app.router.add_get('/api/admin/items', item_api_index)
+    app.router.add_post('/api/admin/orders', order_api_create)
+    app.router.add_post('/api/admin/orders/bulk', order_api_bulk_create)
+    app.router.add_get('/api/admin/orders', order_api_index)
+    app.router.add_get('/api/admin/sales/daily', sales_daily_index)
+    app.router.add_get('/api/admin/sales/items', sales_items_index)
+    app.router.add_get('/api/admin/sales/members', sales_members_index)
+    app.router.add_get('/api/points', point_index)
+    app.router.add_get('/api/points/balance', point_balance)
+    app.router.add_get('/api/profile', profile_api)
+    app.router.add_get('/metrics', metrics_index)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    tracing.configure_logging()
+    web.run_app(create_app(), port=int(os.environ.get('PORT', 8080)))
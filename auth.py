@@ -0,0 +1,160 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import metrics
+
+VERIFY_URL = os.environ.get('LINE_VERIFY_URL', 'https://api.line.me/oauth2/v2.1/verify')
+VERIFY_TIMEOUT = (3.05, 5)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+_session = None
+_session_pid = None
+_cache = {}
+_lock = threading.Lock()
+
+
+class InvalidIdToken(Exception):
+    pass
+
+
+class VerifyUnavailable(Exception):
+    """The verify API could not be reached or answered with something unusable."""
+
+
+def _get_session():
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _session = requests.Session()
+        _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+        _session_pid = os.getpid()
+    return _session
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def verify_locally(token):
+    # LINE Login 以 HS256 簽章的 ID token 可以直接用 channel secret 驗證，不必打 API
+    # ES256 (JWKS) 簽章或未設定 secret 時回傳 None，改用 verify API
+    secret = os.environ.get('LINE_LOGIN_CHANNEL_SECRET')
+    if not secret:
+        return None
+
+    try:
+        header, payload, signature = token.split('.')
+        fields = json.loads(_b64decode(header))
+        # header 與 payload 必須是 JSON object，例如 'W10.e30.sig' 的 header 是 []
+        if not isinstance(fields, dict):
+            raise InvalidIdToken('malformed token')
+        if fields.get('alg') != 'HS256':
+            return None
+        expected = hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            raise InvalidIdToken('signature mismatch')
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidIdToken('malformed token')
+    if not isinstance(claims, dict):
+        raise InvalidIdToken('malformed token')
+
+    if claims.get('iss') != 'https://access.line.me':
+        raise InvalidIdToken('unexpected issuer')
+    if claims.get('aud') != os.environ.get('LINE_CHANNEL_ID'):
+        raise InvalidIdToken('unexpected audience')
+    if claims.get('exp', 0) <= time.time():
+        raise InvalidIdToken('token expired')
+    return claims
+
+
+def _verify_remotely(token):
+    import requests
+
+    try:
+        response = _get_session().post(VERIFY_URL, data={
+            "id_token": token,
+            "client_id": os.environ.get("LINE_CHANNEL_ID"),
+        }, timeout=VERIFY_TIMEOUT)
+        # 5xx 是 LINE 那邊的問題，不代表 token 無效
+        if response.status_code >= 500:
+            raise VerifyUnavailable(f"verify API returned {response.status_code}")
+        if response.status_code != 200:
+            raise InvalidIdToken(response.text)
+        claims = response.json()
+    except requests.RequestException as e:
+        raise VerifyUnavailable(repr(e))
+    except ValueError:
+        raise VerifyUnavailable('verify API returned a body that is not JSON')
+    if not isinstance(claims, dict):
+        raise VerifyUnavailable('verify API returned a body that is not an object')
+    return claims
+
+
+def _cache_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def lookup(token):
+    """Return cached claims for a token that has not expired yet, or None."""
+    key = _cache_key(token)
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        claims, exp = cached
+        if exp > time.time():
+            metrics.inc('token_cache_requests_total', result='hit')
+            return claims
+        with _lock:
+            _cache.pop(key, None)
+    metrics.inc('token_cache_requests_total', result='miss')
+    return None
+
+
+def remember(token, claims):
+    key = _cache_key(token)
+    now = time.time()
+    with _lock:
+        if len(_cache) >= TOKEN_CACHE_SIZE:
+            for k in [k for k, (_, exp) in _cache.items() if exp <= now]:
+                del _cache[k]
+        while len(_cache) >= TOKEN_CACHE_SIZE:
+            del _cache[next(iter(_cache))]
+        _cache[key] = (claims, claims.get('exp', 0))
+
+
+def verify_id_token(token):
+    """Return the claims of a LIFF ID token.
+
+    Raises InvalidIdToken when the token is not valid and VerifyUnavailable when the
+    verify API cannot tell.
+    """
+    if not token:
+        raise InvalidIdToken('missing token')
+
+    claims = lookup(token)
+    if claims is not None:
+        return claims
+
+    start = time.perf_counter()
+    claims = verify_locally(token)
+    if claims is not None:
+        metrics.observe('token_verify_seconds', time.perf_counter() - start, method='local')
+    else:
+        try:
+            claims = _verify_remotely(token)
+        except VerifyUnavailable:
+            metrics.inc('token_verify_failures_total', method='remote')
+            raise
+        finally:
+            metrics.observe('token_verify_seconds', time.perf_counter() - start, method='remote')
+
+    remember(token, claims)
+    return claims
@@ -0,0 +1,91 @@
+# 比較 Flask (uwsgi 4 processes x 2 threads) 與 async_app.py 在對外呼叫有延遲時的吞吐量
+#
+#   python benchmarks/bench_async.py --requests 400 --concurrency 64 --latency 0.1
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+
+from common import bench_env, sign, start, stop, text_event_body, wait_for
+
+
+async def drive(base_url, scenario, total, concurrency):
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    # uwsgi 的 http router 不做 keep-alive，兩邊都每個請求開新連線才公平
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+
+    async def one(session, i):
+        async with semaphore:
+            if scenario == 'points':
+                kwargs = {"headers": {"Authorization": f"Bearer token-{uuid.uuid4().hex}"}}
+                method, path = 'GET', '/api/points'
+            else:
+                body = text_event_body(f"U{i}")
+                kwargs = {"data": body, "headers": {"X-Line-Signature": sign(body)}}
+                method, path = 'POST', '/callback'
+            start = time.perf_counter()
+            async with session.request(method, base_url + path, **kwargs) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(session, i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "rps": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "statuses": statuses,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.1, help='simulated api.line.me latency in seconds')
+    parser.add_argument('--stub-port', type=int, default=9000)
+    parser.add_argument('--port', type=int, default=9001)
+    args = parser.parse_args()
+
+    env = bench_env(args.stub_port, tempfile.mkdtemp(), PORT=str(args.port))
+    servers = {
+        "flask+uwsgi": ['uwsgi', '--http', f':{args.port}', '--wsgi-file', 'wsgi.py', '--callable', 'app',
+                        '--processes', '4', '--threads', '2', '--master', '--die-on-term'],
+        "aiohttp": [sys.executable, 'async_app.py'],
+    }
+
+    stub = start([sys.executable, 'benchmarks/stub_line.py', '--port', str(args.stub_port),
+                  '--latency', str(args.latency)], env)
+    try:
+        await wait_for(f'http://127.0.0.1:{args.stub_port}/')
+        report = {}
+        for name, cmd in servers.items():
+            server = start(cmd, env)
+            try:
+                await wait_for(f'http://127.0.0.1:{args.port}/api/admin/items')
+                for scenario in ('points', 'callback'):
+                    result = await drive(f'http://127.0.0.1:{args.port}', scenario, args.requests, args.concurrency)
+                    report[f"{name} {scenario}"] = result
+                    print(f"{name:12} {scenario:9} {result['rps']:8.1f} req/s  "
+                          f"p50 {result['p50_ms']:7.1f}ms  p99 {result['p99_ms']:7.1f}ms  {result['statuses']}")
+            finally:
+                stop(server)
+    finally:
+        stop(stub)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+# 量測會員卡產生速度：每張卡都重新建立 RenderContext vs. 共用同一個 RenderContext
+#
+#   python benchmarks/bench_card.py --count 50
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import card  # noqa: E402
+
+
+def run(count, shared):
+    context = card.RenderContext() if shared else None
+    start = time.perf_counter()
+    for i in range(count):
+        uid = f"Ubench{i:026d}"
+        card.gen_member_card("Bench", uid, context if shared else card.RenderContext())
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50)
+    args = parser.parse_args()
+
+    before = run(args.count, shared=False)
+    after = run(args.count, shared=True)
+    print(f"per-card context: {before:.2f} cards/s")
+    print(f"shared context:   {after:.2f} cards/s")
+
+
+if __name__ == "__main__":
+    main()
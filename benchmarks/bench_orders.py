@@ -0,0 +1,80 @@
+# 量測 /api/admin/orders 的訂單 / 品項 join
+#
+#   python benchmarks/bench_orders.py --orders 100000 --items 5000
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'bench')
+
+import db  # noqa: E402
+from app import create_app  # noqa: E402
+
+
+def seed(order_count, item_count):
+    items = [{"id": f"item-{i}", "name": f"品項 {i}", "image": "", "price": random.randint(10, 500)}
+             for i in range(item_count)]
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO items (id, name, image, price) VALUES (:id, :name, :image, :price)', items)
+        conn.execute("INSERT OR REPLACE INTO versions (name, version) VALUES ('items', 1)")
+        conn.executemany(
+            'INSERT INTO orders (id, user_id, items, total, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(f"order-{i}", f"U{i % 1000}",
+              '[' + ','.join(f'{{"id": "item-{random.randrange(item_count)}", "qty": 1}}'
+                             for _ in range(random.randint(1, 3))) + ']',
+              0, "2023-11-01T00:00:00") for i in range(order_count)],
+        )
+    return items
+
+
+def linear_join(orders, items):
+    # 原本的做法：每個品項都線性搜尋 item 清單兩次
+    for order in orders:
+        order["items"] = list(map(lambda x: {
+            "id": x["id"],
+            "qty": x["qty"],
+            "name": filter(lambda z: z["id"] == x["id"], items).__next__()["name"],
+            "price": filter(lambda z: z["id"] == x["id"], items).__next__()["price"],
+        }, order["items"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--linear-sample', type=int, default=1000)
+    args = parser.parse_args()
+
+    items = seed(args.orders, args.items)
+    client = create_app().test_client()
+
+    start = time.perf_counter()
+    response = client.get('/api/admin/orders?format=ndjson')
+    lines = sum(1 for _ in response.iter_encoded())
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    print(f"GET /api/admin/orders?format=ndjson ({lines} orders, {args.items} items): {elapsed:.3f}s")
+
+    start = time.perf_counter()
+    response = client.get('/api/admin/orders')
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200
+    print(f"GET /api/admin/orders (first page): {elapsed * 1000:.1f}ms")
+
+    sample = list(itertools.islice(db.iter_orders(), args.linear_sample))
+    start = time.perf_counter()
+    linear_join(sample, items)
+    elapsed = time.perf_counter() - start
+    print(f"linear join, {len(sample)} orders: {elapsed:.3f}s "
+          f"(~{elapsed * args.orders / len(sample):.1f}s extrapolated to {args.orders})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# 本機的 api.line.me 與 api-data.line.me 替身，給壓測、效能測試與 richmenu.py 使用
+#
+#   python benchmarks/stub_line.py --port 9000 --latency 0.05
+import argparse
+import asyncio
+import hashlib
+import time
+import uuid
+
+from aiohttp import web
+
+
+def create_app(latency):
+    async def reply(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.json_response({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    async def push(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.json_response({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    async def empty(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.json_response({})
+
+    async def quota(request):
+        return web.json_response({"type": "none"})
+
+    async def quota_consumption(request):
+        return web.json_response({"totalUsage": 0})
+
+    async def followers(request):
+        return web.json_response({"status": "ready", "followers": 1200, "targetedReaches": 1000, "blocks": 200})
+
+    async def verify(request):
+        form = await request.post()
+        await asyncio.sleep(latency)
+        token = form.get("id_token", "")
+        # 以 invalid 開頭的 token 模擬驗證失敗
+        if not token or token.startswith("invalid"):
+            return web.json_response({"error": "invalid_request", "error_description": "Invalid IdToken."},
+                                     status=400)
+        return web.json_response({
+            "iss": "https://access.line.me",
+            "sub": "U" + hashlib.md5(token.encode()).hexdigest(),
+            "aud": form.get("client_id"),
+            "exp": int(time.time()) + 3600,
+            "name": "bench",
+        })
+
+    # rich menu 狀態只存在記憶體，給 richmenu.py 在本機測試
+    richmenus, aliases, defaults, links = {}, {}, {}, {}
+
+    def not_found(message):
+        return web.json_response({"message": message}, status=404)
+
+    async def richmenu_list(request):
+        return web.json_response({"richmenus": list(richmenus.values())})
+
+    async def richmenu_create(request):
+        menu = dict(await request.json(), richMenuId=f"richmenu-{uuid.uuid4().hex}")
+        richmenus[menu["richMenuId"]] = menu
+        return web.json_response({"richMenuId": menu["richMenuId"]})
+
+    async def richmenu_delete(request):
+        if richmenus.pop(request.match_info["id"], None) is None:
+            return not_found("Not found")
+        return web.json_response({})
+
+    async def richmenu_content(request):
+        body = await request.read()
+        if request.match_info["id"] not in richmenus:
+            return not_found("Not found")
+        if len(body) > 1024 * 1024:
+            return web.json_response({"message": "image too large"}, status=400)
+        return web.json_response({})
+
+    async def alias_list(request):
+        return web.json_response({"aliases": [{"richMenuAliasId": alias_id, "richMenuId": menu_id}
+                                              for alias_id, menu_id in aliases.items()]})
+
+    async def alias_get(request):
+        alias_id = request.match_info["alias"]
+        if alias_id not in aliases:
+            return not_found("richmenu alias not found")
+        return web.json_response({"richMenuAliasId": alias_id, "richMenuId": aliases[alias_id]})
+
+    async def alias_create(request):
+        body = await request.json()
+        if body["richMenuAliasId"] in aliases or body["richMenuId"] not in richmenus:
+            return web.json_response({"message": "conflict richmenu alias id"}, status=400)
+        aliases[body["richMenuAliasId"]] = body["richMenuId"]
+        return web.json_response({})
+
+    async def alias_update(request):
+        body = await request.json()
+        if request.match_info["alias"] not in aliases or body["richMenuId"] not in richmenus:
+            return web.json_response({"message": "richmenu alias not found"}, status=400)
+        aliases[request.match_info["alias"]] = body["richMenuId"]
+        return web.json_response({})
+
+    async def alias_delete(request):
+        if aliases.pop(request.match_info["alias"], None) is None:
+            return web.json_response({"message": "richmenu alias not found"}, status=400)
+        return web.json_response({})
+
+    async def default_get(request):
+        if "id" not in defaults:
+            return not_found("no default richmenu")
+        return web.json_response({"richMenuId": defaults["id"]})
+
+    async def default_set(request):
+        if request.match_info["id"] not in richmenus:
+            return not_found("Not found")
+        defaults["id"] = request.match_info["id"]
+        return web.json_response({})
+
+    async def user_menu_get(request):
+        if request.match_info["user_id"] not in links:
+            return not_found("the user has no richmenu")
+        return web.json_response({"richMenuId": links[request.match_info["user_id"]]})
+
+    async def bulk_link(request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        if body["richMenuId"] not in richmenus or not 1 <= len(body["userIds"]) <= 500:
+            return web.json_response({"message": "invalid request"}, status=400)
+        for user_id in body["userIds"]:
+            links[user_id] = body["richMenuId"]
+        return web.json_response({}, status=202)
+
+    app = web.Application()
+    app.router.add_post('/v2/bot/message/reply', reply)
+    app.router.add_post('/v2/bot/message/push', push)
+    app.router.add_post('/v2/bot/message/multicast', empty)
+    app.router.add_post('/v2/bot/message/narrowcast', empty)
+    app.router.add_get('/v2/bot/message/quota', quota)
+    app.router.add_get('/v2/bot/message/quota/consumption', quota_consumption)
+    app.router.add_get('/v2/bot/insight/followers', followers)
+    app.router.add_post('/oauth2/v2.1/verify', verify)
+    app.router.add_get('/v2/bot/richmenu/list', richmenu_list)
+    app.router.add_post('/v2/bot/richmenu', richmenu_create)
+    app.router.add_post('/v2/bot/richmenu/bulk/link', bulk_link)
+    app.router.add_get('/v2/bot/richmenu/alias/list', alias_list)
+    app.router.add_post('/v2/bot/richmenu/alias', alias_create)
+    app.router.add_get('/v2/bot/richmenu/alias/{alias}', alias_get)
+    app.router.add_post('/v2/bot/richmenu/alias/{alias}', alias_update)
+    app.router.add_delete('/v2/bot/richmenu/alias/{alias}', alias_delete)
+    app.router.add_delete('/v2/bot/richmenu/{id}', richmenu_delete)
+    app.router.add_post('/v2/bot/richmenu/{id}/content', richmenu_content)
+    app.router.add_get('/v2/bot/user/all/richmenu', default_get)
+    app.router.add_post('/v2/bot/user/all/richmenu/{id}', default_set)
+    app.router.add_get('/v2/bot/user/{user_id}/richmenu', user_menu_get)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency), port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
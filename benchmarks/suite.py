@@ -0,0 +1,293 @@
+# 完整的效能測試：對本機的 LINE stub 壓測各 endpoint，再量測會員卡產生與訂單 join，
+# 結果輸出成 JSON，之後可以拿兩次的報告互相比較
+#
+#   python benchmarks/suite.py --requests 500 --concurrency 32 --sizes 1000,10000,100000 --output report.json
+#   python benchmarks/suite.py --compare before.json report.json --threshold 10
+#   python benchmarks/suite.py --seed 42 --skip-load   # 固定種子，資料與請求可以重現
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+from PIL import Image
+
+from common import (
+    ROOT, bench_env, postback_event_body, sandbox, sign, start, stop, text_event_body, wait_for,
+)
+
+SCENARIOS = ('callback_message', 'callback_postback', 'orders_create', 'orders_list', 'points', 'avatar')
+
+
+def avatar_bytes():
+    img = Image.new('RGB', (1200, 1600), (random.randrange(256), 120, 80))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def build_request(scenario, i, items):
+    user_id = f"U{i % 1000:032d}"
+    if scenario == 'callback_message':
+        body = text_event_body(user_id)
+        return 'POST', '/callback', {"data": body, "headers": {"X-Line-Signature": sign(body)}}
+    if scenario == 'callback_postback':
+        body = postback_event_body(user_id, "action=member_card" if i % 2 else "action=catalog&page=1")
+        return 'POST', '/callback', {"data": body, "headers": {"X-Line-Signature": sign(body)}}
+    if scenario == 'orders_create':
+        chosen = random.sample(items, 3)
+        order = {
+            "userId": user_id,
+            "items": [{"id": item["id"], "qty": 2} for item in chosen],
+            "total": sum(item["price"] * 2 for item in chosen),
+        }
+        return 'POST', '/api/admin/orders', {"json": order}
+    if scenario == 'orders_list':
+        return 'GET', '/api/admin/orders?limit=50', {}
+    if scenario == 'points':
+        return 'GET', '/api/points', {"headers": {"Authorization": f"Bearer token-{i % 1000}"}}
+
+    form = aiohttp.FormData()
+    form.add_field('token', f"token-{i % 1000}")
+    form.add_field('avatar', avatar_bytes(), filename='avatar.jpg', content_type='image/jpeg')
+    return 'POST', '/profile/avatar', {"data": form, "allow_redirects": False}
+
+
+async def drive(base_url, scenario, total, concurrency, items):
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    # uwsgi 的 http router 不做 keep-alive，每個請求都開新連線
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+
+    async def one(session, i):
+        method, path, kwargs = build_request(scenario, i, items)
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, **kwargs) as response:
+                    await response.read()
+                    status = str(response.status)
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start_time)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start_time = time.perf_counter()
+        await asyncio.gather(*(one(session, i) for i in range(total)))
+        elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "rps": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p90_ms": latencies[max(0, int(len(latencies) * 0.9) - 1)] * 1000,
+        "p99_ms": latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000,
+        "statuses": statuses,
+    }
+
+
+async def run_load(args, cwd, env, items):
+    stub = start([sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_line.py'), '--port', str(args.stub_port),
+                  '--latency', str(args.latency)], env, cwd)
+    server = start(['uwsgi', '--http', f':{args.port}', '--wsgi-file', 'wsgi.py', '--callable', 'app',
+                    '--processes', str(args.processes), '--threads', str(args.threads), '--master',
+                    '--die-on-term'], env, cwd)
+    results = {}
+    try:
+        await wait_for(f'http://127.0.0.1:{args.stub_port}/')
+        await wait_for(f'http://127.0.0.1:{args.port}/api/admin/items')
+        for scenario in args.scenarios:
+            result = await drive(f'http://127.0.0.1:{args.port}', scenario, args.requests, args.concurrency, items)
+            results[f"load.{scenario}"] = result
+            print(f"{scenario:18} {result['rps']:8.1f} req/s  p50 {result['p50_ms']:7.1f}ms  "
+                  f"p99 {result['p99_ms']:7.1f}ms  {result['statuses']}")
+    finally:
+        stop(server)
+        stop(stub)
+    return results
+
+
+def run_card(count):
+    import card
+    import metrics
+
+    context = card.RenderContext()
+    start_time = time.perf_counter()
+    for i in range(count):
+        card.gen_member_card("Bench", f"Ubench{i:026d}", context)
+    elapsed = time.perf_counter() - start_time
+
+    stages = {}
+    for name, labels, h in metrics.snapshot()["histograms"]:
+        if name == 'card_stage_seconds':
+            stages[f"{labels['stage']}_ms"] = h["sum"] / h["count"] * 1000
+    result = {"cards": count, "cards_per_sec": count / elapsed, "mean_ms": elapsed / count * 1000, **stages}
+    print(f"gen_member_card    {result['cards_per_sec']:8.2f} cards/s")
+    return {"micro.card": result}
+
+
+def seed_orders(count, items):
+    import db
+
+    existing = db.connect().execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+    batch = 50000
+    for offset in range(existing, count, batch):
+        rows = []
+        for i in range(offset, min(count, offset + batch)):
+            chosen = random.sample(items, random.randint(1, 3))
+            rows.append((f"bench-{i}", f"U{i % 1000:032d}",
+                         json.dumps([{"id": item["id"], "qty": 1} for item in chosen]),
+                         sum(item["price"] for item in chosen), "2023-11-01T00:00:00"))
+        with db.transaction() as conn:
+            conn.executemany('INSERT INTO orders (id, user_id, items, total, created_at) VALUES (?, ?, ?, ?, ?)',
+                             rows)
+
+
+def run_join(sizes):
+    import catalog
+    import db
+    import orders
+
+    items = catalog.get_catalog()
+    results = {}
+    for size in sizes:
+        seed_orders(size, items.items)
+        start_time = time.perf_counter()
+        joined = sum(1 for order in itertools.islice(db.iter_orders(), size)
+                     if orders.join_order_items(order, items))
+        elapsed = time.perf_counter() - start_time
+        results[f"micro.join.{size}"] = {"orders": joined, "orders_per_sec": joined / elapsed,
+                                         "total_ms": elapsed * 1000}
+        print(f"order join {size:>8} {joined / elapsed:10.0f} orders/s")
+    return results
+
+
+def seed_items(count):
+    import db
+
+    # 已經有品項時沿用資料庫裡的價格，訂單總額才會跟 server 算的一致
+    if db.connect().execute('SELECT COUNT(*) FROM items').fetchone()[0]:
+        return db.list_items()
+    items = [{"id": f"bench-item-{i}", "name": f"品項 {i}", "image": "", "price": random.randint(10, 500)}
+             for i in range(count)]
+    for item in items:
+        db.create_item(item)
+    return items
+
+
+def meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "args": {k: v for k, v in vars(args).items() if k not in ('compare', 'output')},
+    }
+
+
+def compare(before_path, after_path, threshold):
+    with open(before_path) as f:
+        before = json.load(f)["results"]
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+
+    regressions = []
+    for name in sorted(set(before) & set(after)):
+        for field, old in before[name].items():
+            new = after[name].get(field)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+                continue
+            higher_is_better = field == 'rps' or field.endswith('_per_sec')
+            if not higher_is_better and not field.endswith('_ms'):
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append(f"{name}.{field}")
+            print(f"{name:28} {field:16} {old:12.2f} -> {new:12.2f}  {change:+7.1f}%{flag}")
+    if regressions:
+        raise SystemExit(f"{len(regressions)} metrics regressed by more than {threshold}%")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated api.line.me latency in seconds')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--stub-port', type=int, default=9000)
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--cards', type=int, default=50)
+    parser.add_argument('--sizes', default='1000,10000,100000', help='order counts for the join benchmark')
+    parser.add_argument('--font', help='TrueType font to use when the repo has no static/font.ttf')
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--seed', type=int, help='seed for the generated items, orders and requests (default: random)')
+    parser.add_argument('--output', default='benchmark-report.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=10, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare, args.threshold)
+        return
+
+    args.scenarios = [s for s in args.scenarios.split(',') if s]
+    sizes = sorted(int(s) for s in args.sizes.split(',') if s)
+
+    cwd = sandbox()
+    if args.font:
+        os.symlink(os.path.abspath(args.font), os.path.join(cwd, 'static', 'font.ttf'))
+    env = bench_env(args.stub_port, cwd)
+    # 本行程的 db / card 模組與 server 共用同一個資料庫與工作目錄
+    os.environ.update(env)
+    os.chdir(cwd)
+    sys.path.insert(0, cwd)
+
+    # 種子寫進報告，用同一個種子重跑就能產生一樣的資料與請求
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2 ** 32)
+    random.seed(args.seed)
+    items = seed_items(args.items)
+    results = {}
+    if not args.skip_load:
+        results.update(asyncio.run(run_load(args, cwd, env, items)))
+    if not args.skip_micro:
+        results.update(run_card(args.cards))
+        results.update(run_join(sizes))
+
+    report = {"meta": meta(args), "results": results}
+    report["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    output = os.path.join(ROOT, args.output) if not os.path.isabs(args.output) else args.output
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"report written to {output} (work directory {cwd})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import assets
+import db
+import metrics
+import storage
+
+CARD_WORKERS = int(os.environ.get('CARD_WORKERS', 2))
+CARD_MAX_PENDING = int(os.environ.get('CARD_MAX_PENDING', 64))
+CARD_CACHE_MAX_BYTES = int(os.environ.get('CARD_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+TEMPLATE_PATH = "static/card.png"
+FONT_PATH = "static/font.ttf"
+DEFAULT_AVATAR_PATH = "static/avatar/default.png"
+
+# qrcode 預設會把八種 mask 都試過挑最好的，佔掉大部分時間；固定一種掃描起來一樣
+QR_MASK_PATTERN = 0
+QR_BOX_SIZE = 10
+# 批次產生時每個 worker 一次拿到的會員數
+BATCH_CHUNK_SIZE = 16
+# /api/profile 遇到被淘汰的會員卡時，重新產生最多等這麼久
+PROFILE_RENDER_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_in_flight = {}
+_lock = threading.Lock()
+
+
+def card_path(uid):
+    return storage.path('card', uid, '.png')
+
+
+def card_files(uid):
+    return [storage.path('card', uid, suffix) for suffix in storage.SUFFIXES['card']]
+
+
+def profile_urls(uid):
+    """Return the avatar and card URLs of a member for /api/profile."""
+    # 檔案分散在雜湊目錄底下，前端不能自己組網址
+    ready = card_ready(uid)
+    if os.path.exists(storage.path('avatar', uid)):
+        avatar_url = storage.versioned_url('avatar', uid)
+    else:
+        avatar_url = assets.versioned_url(DEFAULT_AVATAR_PATH)
+    return {
+        "user_id": uid,
+        "avatar_url": avatar_url,
+        "card_url": storage.versioned_url('card', uid, '.png') if ready else None,
+        "qr_url": storage.versioned_url('card', uid, '_qr.png') if ready else None,
+        "barcode_url": storage.versioned_url('card', uid, '_barcode.png') if ready else None,
+    }
+
+
+def card_ready(uid):
+    return os.path.exists(card_path(uid))
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return "-"
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def card_key(name, uid):
+    # 會員卡只由這些輸入決定；頭像、樣板或字型被換掉時 mtime / size 會變，key 也跟著變
+    avatar_path = storage.path('avatar', uid)
+    if not os.path.exists(avatar_path):
+        avatar_path = DEFAULT_AVATAR_PATH
+
+    parts = [name, uid, _file_signature(avatar_path), _file_signature(TEMPLATE_PATH), _file_signature(FONT_PATH)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def _get_executor():
+    # uwsgi fork 出 worker 之後才建立 process pool
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ProcessPoolExecutor(max_workers=CARD_WORKERS, initializer=_init_worker)
+        _executor_pid = os.getpid()
+        _in_flight.clear()
+    return _executor
+
+
+def _on_done(uid, future):
+    with _lock:
+        if _in_flight.get(uid) is future:
+            del _in_flight[uid]
+
+
+def ensure_card(name, uid):
+    """Queue a render unless the cached card already matches its inputs; returns the future or None."""
+    key = card_key(name, uid)
+    entry = db.get_card_cache(uid)
+    if entry is not None and entry["key"] == key and card_ready(uid):
+        db.touch_card_cache(uid, time.time())
+        return None
+    return render_async(name, uid, key)
+
+
+def render_async(name, uid, key=None):
+    """Queue a member card render; returns the pending future, or None when the queue is full."""
+    if key is None:
+        key = card_key(name, uid)
+    with _lock:
+        executor = _get_executor()
+        future = _in_flight.get(uid)
+        if future is not None:
+            return future
+        if len(_in_flight) >= CARD_MAX_PENDING:
+            return None
+        future = executor.submit(_render_cached, name, uid, key)
+        _in_flight[uid] = future
+    future.add_done_callback(lambda f: _on_done(uid, f))
+    return future
+
+
+def wait_for_card(name, uid, timeout=PROFILE_RENDER_TIMEOUT):
+    """Re-render a card that is missing, e.g. evicted from the cache, waiting up to timeout seconds."""
+    if card_ready(uid):
+        return True
+    future = ensure_card(name, uid)
+    if future is not None:
+        # 逾時的話 render 仍會在背景完成，下次開啟頁面就有了
+        done, _ = wait([future], timeout=timeout)
+        if done and future.exception() is not None:
+            logger.warning('Card render for %s failed: %r', uid, future.exception())
+    return card_ready(uid)
+
+
+def _render_cached(name, uid, key, evict=True):
+    gen_member_card(name, uid)
+    size = sum(os.path.getsize(path) for path in card_files(uid) if os.path.exists(path))
+    db.put_card_cache(uid, key, size, time.time())
+    if evict:
+        evict_cards(CARD_CACHE_MAX_BYTES)
+
+
+def _render_chunk(users):
+    rendered, failed = 0, []
+    for name, uid, key in users:
+        try:
+            # 批次產生的卡片不該把同一批剛產生的卡片擠掉，淘汰交給平常的 render
+            _render_cached(name, uid, key, evict=False)
+            rendered += 1
+        except Exception as e:
+            failed.append((uid, repr(e)))
+    return rendered, failed
+
+
+def _chunks(users, force):
+    chunk = []
+    for name, uid in users:
+        key = card_key(name, uid)
+        if not force:
+            entry = db.get_card_cache(uid)
+            if entry is not None and entry["key"] == key and card_ready(uid):
+                continue
+        chunk.append((name, uid, key))
+        if len(chunk) == BATCH_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_batch(users, workers=None, force=False, progress=None):
+    """Render cards for an iterable of (name, uid) on every core, streaming the input.
+
+    Cards whose cached key still matches are skipped unless force is set. Returns
+    (rendered, failed) where failed lists (uid, error); progress(rendered) is called
+    after every finished chunk.
+    """
+    workers = workers or os.cpu_count() or 1
+    rendered, failed = 0, []
+    pending = set()
+    # 只讓 workers * 2 個 chunk 在排隊，會員名單再長記憶體用量也固定
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for chunk in _chunks(users, force):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count, errors = future.result()
+                    rendered += count
+                    failed.extend(errors)
+                    if progress:
+                        progress(rendered)
+            pending.add(executor.submit(_render_chunk, chunk))
+        for future in pending:
+            count, errors = future.result()
+            rendered += count
+            failed.extend(errors)
+            if progress:
+                progress(rendered)
+    return rendered, failed
+
+
+def evict_cards(max_bytes):
+    """Delete least recently used cards until the card files fit in max_bytes."""
+    total = db.card_cache_total_size()
+    while total > max_bytes:
+        entries = db.least_recent_card_cache(100)
+        if not entries:
+            break
+        for entry in entries:
+            for path in card_files(entry["user_id"]):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            db.delete_card_cache(entry["user_id"])
+            total -= entry["size"]
+            if total <= max_bytes:
+                break
+    return total
+
+
+class RenderContext:
+    """Decoded template, fonts and default avatar shared by every render in one process."""
+
+    AVATAR_WIDTH = 800
+    AVATAR_POSITION = (300, 600)
+    TEXT_POSITIONS = [(1800, 860), (1800, 980), (1800, 1100)]
+    QR_SIZE = (400, 400)
+    QR_POSITION = (2400, 1300)
+    BARCODE_POSITION = (1250, 1300)
+
+    def __init__(self, template_path=TEMPLATE_PATH, font_path=FONT_PATH, default_avatar_path=DEFAULT_AVATAR_PATH):
+        from PIL import Image
+
+        self.signature = (_file_signature(template_path), _file_signature(font_path))
+        self.font_path = font_path
+        self.fonts = {}
+
+        self.template = Image.open(template_path)
+        self.template.load()
+
+        self.default_avatar = self.fit_avatar(Image.open(default_avatar_path))
+
+    def font(self, size):
+        if size not in self.fonts:
+            from PIL import ImageFont
+            self.fonts[size] = ImageFont.truetype(self.font_path, size)
+        return self.fonts[size]
+
+    def fit_avatar(self, avatar):
+        # 上傳時已經縮好的頭像不必再縮放
+        if avatar.size[0] == self.AVATAR_WIDTH:
+            return avatar
+        wpercent = (self.AVATAR_WIDTH / float(avatar.size[0]))
+        hsize = int((float(avatar.size[1]) * float(wpercent)))
+        return avatar.resize((self.AVATAR_WIDTH, hsize))
+
+
+_context = None
+
+
+def get_context():
+    # 樣板或字型被替換時重新載入
+    global _context
+    if _context is None or _context.signature != (_file_signature(TEMPLATE_PATH), _file_signature(FONT_PATH)):
+        _context = RenderContext()
+    return _context
+
+
+def _init_worker():
+    get_context()
+
+
+def qr_image(uid):
+    """Render the QR code of uid as a mode "1" image with one pixel per module."""
+    import qrcode
+    from PIL import Image
+
+    qr = qrcode.QRCode(border=1, mask_pattern=QR_MASK_PATTERN)
+    qr.add_data(uid)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    # 直接把 module 矩陣寫進 PIL 的 buffer，不經過 qrcode 逐格畫方塊
+    return Image.frombytes('1', (size, size), bytes(0 if dark else 255 for row in matrix for dark in row),
+                           'raw', '1;8')
+
+
+_barcode_writer = None
+
+
+def barcode_image(code):
+    """Render a Code128 barcode with its text, the same image ImageWriter produces."""
+    global _barcode_writer
+    from barcode import Code128
+
+    if _barcode_writer is None:
+        from barcode.writer import ImageWriter  # 載入 barcode.writer 的 ImageWriter
+
+        class BarcodeWriter(ImageWriter):
+            def _paint_module(self, xpos, ypos, width, color):
+                # 畫布已經是白底，白色的 module 不必再畫一次
+                if color != self.background:
+                    super()._paint_module(xpos, ypos, width, color)
+
+        _barcode_writer = BarcodeWriter
+    return Code128(code, writer=_barcode_writer()).render()
+
+
+def gen_member_card(name, uid, context=None):
+    # 產生會員卡才需要的套件，只在 render 的 process 載入
+    from PIL import Image, ImageDraw
+
+    import images
+
+    if context is None:
+        context = get_context()
+
+    img = context.template.copy()
+
+    card_file = storage.makedirs(card_path(uid))
+
+    with metrics.timer('card_stage_seconds', stage='qr'):
+        qr = qr_image(uid)
+        qr.resize((qr.size[0] * QR_BOX_SIZE, qr.size[1] * QR_BOX_SIZE), Image.NEAREST).save(
+            storage.path('card', uid, '_qr.png'))
+
+    # barcode 直接在記憶體中產生，存檔後不必再讀回來
+    with metrics.timer('card_stage_seconds', stage='barcode'):
+        barcode = barcode_image(uid[1:].zfill(12))
+        barcode.save(storage.path('card', uid, '_barcode.png'))
+
+    with metrics.timer('card_stage_seconds', stage='avatar'):
+        avatar_path = storage.path('avatar', uid)
+        if os.path.exists(avatar_path):
+            avatar = context.fit_avatar(Image.open(avatar_path, formats=["png", "jpeg"]))
+        else:
+            avatar = context.default_avatar
+        img.paste(avatar, context.AVATAR_POSITION)
+
+    with metrics.timer('card_stage_seconds', stage='text'):
+        # Call draw Method to add 2D graphics in an image
+        I1 = ImageDraw.Draw(img)
+        # Add Text to an image
+        font = context.font(64)
+        for position, text in zip(context.TEXT_POSITIONS, [name, uid, "綠星會員"]):
+            I1.text(position, text, fill=(0, 0, 0), font=font)
+
+    # Resize the QR code
+    qr = qr.resize(context.QR_SIZE, Image.NEAREST)
+    # Paste the QR code into the image
+    img.paste(qr, context.QR_POSITION)
+
+    img.paste(barcode, context.BARCODE_POSITION)
+
+    with metrics.timer('card_stage_seconds', stage='save'):
+        # LINE 預覽圖用的縮圖，要在會員卡就緒之前寫好
+        images.save_jpeg(images.flatten(images.thumbnail(img)), storage.path('card', uid, '_preview.jpg'))
+
+        # Save the edited image
+        # 先寫到暫存檔再改名，避免讀到寫到一半的會員卡
+        img.save(f"{card_file}.tmp", format="png")
+        os.replace(f"{card_file}.tmp", card_file)
@@ -0,0 +1,31 @@
+import threading
+
+import db
+
+
+class Catalog:
+    def __init__(self, version, items):
+        self.version = version
+        self.items = items
+        self.by_id = {item["id"]: item for item in items}
+
+    def get(self, item_id):
+        return self.by_id.get(item_id)
+
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def get_catalog():
+    """Return the item catalog, reloading it only when the items version in the database changed."""
+    global _catalog
+    version = db.get_version('items')
+    catalog = _catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+
+    with _lock:
+        if _catalog is None or _catalog.version != version:
+            _catalog = Catalog(version, db.list_items())
+        return _catalog
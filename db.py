@@ -0,0 +1,809 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'data/linebot.db')
+# FULL：每次 commit 都 fsync WAL 才回應，已經回給店員的訂單與點數在斷電後也還在。
+# 設成 NORMAL 是放寬耐久性換取速度 (commit 不 fsync，斷電或當機可能掉最後幾筆已回應的 commit，
+# 資料庫本身不會損毀)，不是 group commit
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'FULL')
+# 讀取直接走 mmap，不必經過 read() 複製到 page cache 之外的 buffer
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# WAL 累積這麼多 page 後由 commit 的連線順手 checkpoint
+SQLITE_WAL_AUTOCHECKPOINT = int(os.environ.get('SQLITE_WAL_AUTOCHECKPOINT', 1000))
+# checkpoint 後把 WAL 截到這個大小，避免一次大量匯入後 WAL 一直佔著空間
+SQLITE_JOURNAL_SIZE_LIMIT = int(os.environ.get('SQLITE_JOURNAL_SIZE_LIMIT', 64 * 1024 * 1024))
+# 空頁佔整個資料庫的比例超過這個值，compact 才會 VACUUM
+VACUUM_FREE_RATIO = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS items (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    image TEXT NOT NULL,
+    price INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    items TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id, seq);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+
+CREATE TABLE IF NOT EXISTS points (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    description TEXT NOT NULL,
+    order_id TEXT,
+    point INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS points_user_id ON points (user_id, seq);
+
+CREATE TABLE IF NOT EXISTS balances (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notifications_due ON notifications (status, next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_events_received_at ON webhook_events (received_at);
+
+CREATE TABLE IF NOT EXISTS card_cache (
+    user_id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS card_cache_accessed_at ON card_cache (accessed_at);
+
+-- card_cache 的 size 總和，每次 render 後都要比對上限，不能每次都 SUM 整張表
+CREATE TABLE IF NOT EXISTS card_cache_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day TEXT PRIMARY KEY,
+    orders INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    points INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sales_items (
+    day TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    orders INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    PRIMARY KEY (day, item_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_members (
+    user_id TEXT PRIMARY KEY,
+    orders INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    revenue INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    last_order_at TEXT
+);
+CREATE INDEX IF NOT EXISTS sales_members_revenue ON sales_members (revenue);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at);
+"""
+
+# 既有資料庫的欄位變更，依序套用並記錄在 PRAGMA user_version
+MIGRATIONS = [
+    'ALTER TABLE items ADD COLUMN thumbnail TEXT',
+    'ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS users_version ON users (version)',
+    'INSERT OR IGNORE INTO card_cache_size (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM card_cache',
+    'ALTER TABLE notifications ADD COLUMN retry_key TEXT',
+    'CREATE INDEX IF NOT EXISTS notifications_retry_key ON notifications (retry_key) WHERE retry_key IS NOT NULL',
+]
+
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+_local = threading.local()
+
+
+class IdempotencyConflict(Exception):
+    """The idempotency key was already used for a different request."""
+
+
+def connect():
+    # 每個 process / thread 各自持有一條連線，fork 之後不可沿用父行程的連線
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    directory = os.path.dirname(DATABASE_PATH)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA wal_autocheckpoint={SQLITE_WAL_AUTOCHECKPOINT}')
+    conn.execute(f'PRAGMA journal_size_limit={SQLITE_JOURNAL_SIZE_LIMIT}')
+    conn.execute('PRAGMA foreign_keys=ON')
+    conn.executescript(SCHEMA)
+    _migrate(conn)
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def _migrate(conn):
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for statement in MIGRATIONS[version:]:
+            conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+@contextmanager
+def transaction():
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def compact(vacuum=None):
+    """Checkpoint the WAL into the database and truncate it, then VACUUM if asked to.
+
+    With vacuum=None the database is vacuumed only when at least VACUUM_FREE_RATIO of
+    its pages are free. Returns the sizes before and after.
+    """
+    conn = connect()
+    stats = {"db_bytes_before": _file_size(DATABASE_PATH), "wal_bytes_before": _file_size(f"{DATABASE_PATH}-wal")}
+    busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if vacuum is None:
+        vacuum = page_count > 0 and free_pages / page_count >= VACUUM_FREE_RATIO
+    if vacuum:
+        # WAL 模式下 VACUUM 會把整個資料庫寫進 WAL，要再 checkpoint 一次
+        conn.execute('VACUUM')
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    conn.execute('PRAGMA optimize')
+    stats.update(
+        busy=bool(busy),
+        vacuumed=bool(vacuum),
+        free_pages=free_pages,
+        page_count=page_count,
+        db_bytes=_file_size(DATABASE_PATH),
+        wal_bytes=_file_size(f"{DATABASE_PATH}-wal"),
+    )
+    return stats
+
+
+def get_version(name):
+    row = connect().execute('SELECT version FROM versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def _bump_version(conn, name):
+    conn.execute(
+        'INSERT INTO versions (name, version) VALUES (?, 1) '
+        'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+        (name,),
+    )
+
+
+@metrics.timer('db_seconds', op='get_user')
+def get_user(user_id):
+    row = connect().execute('SELECT id, name FROM users WHERE id = ?', (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+@metrics.timer('db_seconds', op='get_or_create_user')
+def get_or_create_user(user_id, name, rename=False):
+    """Return the member, inserting it when missing; rename=True also stores a changed name."""
+    with transaction() as conn:
+        row = conn.execute('SELECT id, name FROM users WHERE id = ?', (user_id,)).fetchone()
+        if row is not None and (not rename or row["name"] == name):
+            return dict(row)
+        # 每次新增或改名都記下新的 users 版本，其他 worker 只需要讀這之後變動的會員
+        _bump_version(conn, 'users')
+        version = conn.execute("SELECT version FROM versions WHERE name = 'users'").fetchone()[0]
+        conn.execute(
+            'INSERT INTO users (id, name, version) VALUES (?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name, version = excluded.version',
+            (user_id, name, version),
+        )
+    return {"id": user_id, "name": name}
+
+
+def users_changed_since(version):
+    rows = connect().execute('SELECT id, name FROM users WHERE version > ?', (version,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def count_users():
+    return connect().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+
+def iter_users(batch_size=1000):
+    """Yield every member as {"id", "name"} without loading them all into memory."""
+    cursor = connect().cursor()
+    cursor.execute('SELECT id, name FROM users ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(row)
+
+
+@metrics.timer('db_seconds', op='list_items')
+def list_items():
+    rows = connect().execute('SELECT id, name, image, thumbnail, price FROM items ORDER BY seq').fetchall()
+    return [dict(row) for row in rows]
+
+
+@metrics.timer('db_seconds', op='create_item')
+def create_item(item):
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO items (id, name, image, thumbnail, price) VALUES (:id, :name, :image, :thumbnail, :price)',
+            {"thumbnail": None, **item},
+        )
+        _bump_version(conn, 'items')
+    return item
+
+
+def update_item_images(updates):
+    """Rewrite image / thumbnail URLs from [(id, image, thumbnail)]."""
+    with transaction() as conn:
+        conn.executemany(
+            'UPDATE items SET image = ?, thumbnail = ? WHERE id = ?',
+            [(image, thumbnail, item_id) for item_id, image, thumbnail in updates],
+        )
+        _bump_version(conn, 'items')
+
+
+def _order_from_row(row):
+    order = dict(row)
+    order.pop("seq", None)
+    order["items"] = json.loads(order["items"])
+    return order
+
+
+def _order_query(user_id=None, since=None, until=None, before=None):
+    clauses = []
+    params = []
+    if user_id is not None:
+        clauses.append('user_id = ?')
+        params.append(user_id)
+    if since is not None:
+        clauses.append('created_at >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append('created_at < ?')
+        params.append(until)
+    if before is not None:
+        clauses.append('seq < ?')
+        params.append(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return f'SELECT seq, id, user_id, items, total, created_at FROM orders {where} ORDER BY seq DESC', params
+
+
+@metrics.timer('db_seconds', op='page_orders')
+def page_orders(limit, user_id=None, since=None, until=None, before=None):
+    """Return (orders, next_cursor), newest first; next_cursor is None on the last page."""
+    sql, params = _order_query(user_id, since, until, before)
+    rows = connect().execute(f'{sql} LIMIT ?', params + [limit + 1]).fetchall()
+    next_cursor = rows[limit - 1]["seq"] if len(rows) > limit else None
+    metrics.observe('db_payload_bytes', sum(len(row["items"]) for row in rows), buckets=metrics.SIZE_BUCKETS,
+                    op='page_orders')
+    orders = [_order_from_row(row) for row in rows[:limit]]
+    return orders, next_cursor
+
+
+def iter_orders(user_id=None, since=None, until=None, batch_size=1000):
+    """Yield matching orders newest first without loading them all into memory."""
+    sql, params = _order_query(user_id, since, until)
+    cursor = connect().cursor()
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield _order_from_row(row)
+
+
+def _insert_order(conn, order, point_record, notification=None):
+    items = json.dumps(order["items"])
+    metrics.observe('db_payload_bytes', len(items), buckets=metrics.SIZE_BUCKETS, op='create_order')
+    conn.execute(
+        'INSERT INTO orders (id, user_id, items, total, created_at) VALUES (?, ?, ?, ?, ?)',
+        (order["id"], order["user_id"], items, order["total"], order.get("created_at")),
+    )
+    conn.execute(
+        'INSERT INTO points (id, user_id, description, order_id, point, created_at) '
+        'VALUES (:id, :user_id, :description, :order_id, :point, :created_at)',
+        point_record,
+    )
+    _add_balance(conn, point_record["user_id"], point_record["point"])
+    placeholders = ', '.join('?' * len(order["items"]))
+    prices = dict(conn.execute(f'SELECT id, price FROM items WHERE id IN ({placeholders})',
+                               [x["id"] for x in order["items"]]).fetchall())
+    _add_sales(conn, order, point_record["point"], prices)
+    if notification is not None:
+        _enqueue_notification(conn, point_record["user_id"], notification)
+
+
+def _order_day(order):
+    # created_at 是營業時區 (orders.BUSINESS_TIMEZONE) 的時間，前 10 個字就是營業日
+    # 從舊 JSON 匯入、沒有時間的訂單歸在空字串這一天
+    return (order.get("created_at") or "")[:10]
+
+
+def _add_sales(conn, order, points, prices):
+    """Add one order to the per-day, per-item and per-member rollups."""
+    day = _order_day(order)
+    # 早期的訂單數量是字串
+    quantity = sum(int(x["qty"]) for x in order["items"])
+    conn.execute(
+        'INSERT INTO sales_daily (day, orders, quantity, revenue, points) VALUES (?, 1, ?, ?, ?) '
+        'ON CONFLICT (day) DO UPDATE SET orders = orders + 1, quantity = quantity + excluded.quantity, '
+        'revenue = revenue + excluded.revenue, points = points + excluded.points',
+        (day, quantity, order["total"], points),
+    )
+    conn.executemany(
+        'INSERT INTO sales_items (day, item_id, orders, quantity, revenue) VALUES (?, ?, 1, ?, ?) '
+        'ON CONFLICT (day, item_id) DO UPDATE SET orders = orders + 1, quantity = quantity + excluded.quantity, '
+        'revenue = revenue + excluded.revenue',
+        [(day, x["id"], int(x["qty"]), int(x["qty"]) * int(prices.get(x["id"], 0))) for x in order["items"]],
+    )
+    conn.execute(
+        'INSERT INTO sales_members (user_id, orders, quantity, revenue, points, last_order_at) '
+        'VALUES (?, 1, ?, ?, ?, ?) '
+        'ON CONFLICT (user_id) DO UPDATE SET orders = orders + 1, quantity = quantity + excluded.quantity, '
+        'revenue = revenue + excluded.revenue, points = points + excluded.points, '
+        "last_order_at = NULLIF(MAX(COALESCE(last_order_at, ''), COALESCE(excluded.last_order_at, '')), '')",
+        (order["user_id"], quantity, order["total"], points, order.get("created_at")),
+    )
+
+
+@metrics.timer('db_seconds', op='create_orders')
+def create_orders(entries, idempotency_key=None, fingerprint=None):
+    """Store [(order, point_record, notification)] in one transaction; returns (orders, created).
+
+    When idempotency_key was already used for the same fingerprint the orders stored by that
+    request are returned instead and nothing is written; a different fingerprint raises
+    IdempotencyConflict.
+    """
+    orders = [order for order, _, _ in entries]
+    # 訂單與積點紀錄 (以及要推播的通知) 必須同時寫入，避免只有其中一筆成功
+    with transaction() as conn:
+        if idempotency_key is not None:
+            row = conn.execute(
+                'SELECT fingerprint, response FROM idempotency_keys WHERE key = ?',
+                (idempotency_key,),
+            ).fetchone()
+            if row is not None:
+                if row["fingerprint"] != fingerprint:
+                    raise IdempotencyConflict(idempotency_key)
+                return json.loads(row["response"]), False
+
+        for order, point_record, notification in entries:
+            _insert_order(conn, order, point_record, notification)
+
+        if idempotency_key is not None:
+            now = time.time()
+            conn.execute(
+                'INSERT INTO idempotency_keys (key, fingerprint, response, created_at) VALUES (?, ?, ?, ?)',
+                (idempotency_key, fingerprint, json.dumps(orders, ensure_ascii=False), now),
+            )
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - IDEMPOTENCY_KEY_TTL,))
+    return orders, True
+
+
+@metrics.timer('db_seconds', op='page_points')
+def page_points(user_id, limit, before=None):
+    """Return (point records, next_cursor) for one user, newest first."""
+    sql = 'SELECT seq, id, user_id, description, order_id, point, created_at FROM points WHERE user_id = ?'
+    params = [user_id]
+    if before is not None:
+        sql += ' AND seq < ?'
+        params.append(before)
+    rows = connect().execute(f'{sql} ORDER BY seq DESC LIMIT ?', params + [limit + 1]).fetchall()
+    next_cursor = rows[limit - 1]["seq"] if len(rows) > limit else None
+    points = [dict(row) for row in rows[:limit]]
+    for point in points:
+        del point["seq"]
+    return points, next_cursor
+
+
+def _add_balance(conn, user_id, point):
+    conn.execute(
+        'INSERT INTO balances (user_id, balance) VALUES (?, ?) '
+        'ON CONFLICT (user_id) DO UPDATE SET balance = balance + excluded.balance',
+        (user_id, point),
+    )
+
+
+@metrics.timer('db_seconds', op='get_balance')
+def get_balance(user_id):
+    row = connect().execute('SELECT balance FROM balances WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def _rebuild_balances(conn):
+    conn.execute('DELETE FROM balances')
+    conn.execute('INSERT INTO balances (user_id, balance) SELECT user_id, SUM(point) FROM points GROUP BY user_id')
+
+
+def rebuild_balances():
+    with transaction() as conn:
+        _rebuild_balances(conn)
+        return conn.execute('SELECT COUNT(*) FROM balances').fetchone()[0]
+
+
+def _rebuild_sales(conn):
+    # 一次掃過全部訂單，在記憶體裡加總後整批寫回；舊訂單的品項金額以目前的價格計算
+    prices = dict(conn.execute('SELECT id, price FROM items').fetchall())
+    daily, items, members = {}, {}, {}
+    cursor = conn.execute(
+        'SELECT orders.user_id, orders.items, orders.total, orders.created_at, COALESCE(points.point, 0) '
+        'FROM orders LEFT JOIN points ON points.order_id = orders.id ORDER BY orders.seq'
+    )
+    for user_id, order_items, total, created_at, points in cursor:
+        order_items = json.loads(order_items)
+        day = _order_day({"created_at": created_at})
+        quantity = sum(int(x["qty"]) for x in order_items)
+
+        row = daily.setdefault(day, [0, 0, 0, 0])
+        row[0] += 1
+        row[1] += quantity
+        row[2] += total
+        row[3] += points
+        for x in order_items:
+            row = items.setdefault((day, x["id"]), [0, 0, 0])
+            row[0] += 1
+            row[1] += int(x["qty"])
+            row[2] += int(x["qty"]) * int(prices.get(x["id"], 0))
+        row = members.setdefault(user_id, [0, 0, 0, 0, None])
+        row[0] += 1
+        row[1] += quantity
+        row[2] += total
+        row[3] += points
+        row[4] = max(row[4] or "", created_at or "") or None
+
+    conn.execute('DELETE FROM sales_daily')
+    conn.execute('DELETE FROM sales_items')
+    conn.execute('DELETE FROM sales_members')
+    conn.executemany('INSERT INTO sales_daily (day, orders, quantity, revenue, points) VALUES (?, ?, ?, ?, ?)',
+                     [(day, *row) for day, row in daily.items()])
+    conn.executemany('INSERT INTO sales_items (day, item_id, orders, quantity, revenue) VALUES (?, ?, ?, ?, ?)',
+                     [(*key, *row) for key, row in items.items()])
+    conn.executemany('INSERT INTO sales_members (user_id, orders, quantity, revenue, points, last_order_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', [(user_id, *row) for user_id, row in members.items()])
+    return sum(row[0] for row in daily.values())
+
+
+def rebuild_sales():
+    """Recompute the sales rollups from the order history; returns the number of orders counted."""
+    # 重建期間擋住新的訂單，避免新訂單被漏算或算兩次
+    with transaction() as conn:
+        return _rebuild_sales(conn)
+
+
+def _range_clause(column, since, until):
+    clauses, params = [], []
+    if since is not None:
+        clauses.append(f'{column} >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append(f'{column} < ?')
+        params.append(until)
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+
+@metrics.timer('db_seconds', op='sales_daily')
+def sales_daily(since=None, until=None):
+    where, params = _range_clause('day', since, until)
+    rows = connect().execute(
+        f'SELECT day, orders, quantity, revenue, points FROM sales_daily {where} ORDER BY day', params
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@metrics.timer('db_seconds', op='sales_items')
+def sales_items(since=None, until=None):
+    where, params = _range_clause('day', since, until)
+    rows = connect().execute(
+        'SELECT item_id AS id, SUM(orders) AS orders, SUM(quantity) AS quantity, SUM(revenue) AS revenue '
+        f'FROM sales_items {where} GROUP BY item_id ORDER BY revenue DESC', params
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@metrics.timer('db_seconds', op='sales_members')
+def sales_members(limit, user_id=None):
+    """Return the members with the highest revenue, or just user_id's rollup."""
+    sql = ('SELECT sales_members.user_id, users.name, orders, quantity, revenue, points, last_order_at '
+           'FROM sales_members LEFT JOIN users ON users.id = sales_members.user_id')
+    if user_id is not None:
+        rows = connect().execute(f'{sql} WHERE sales_members.user_id = ?', (user_id,)).fetchall()
+    else:
+        rows = connect().execute(f'{sql} ORDER BY revenue DESC LIMIT ?', (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def verify_balances():
+    """Return [(user_id, ledger_total, balance)] for every user whose stored balance drifted from the ledger."""
+    rows = connect().execute("""
+        SELECT ledger.user_id, ledger.total, balances.balance
+        FROM (SELECT user_id, SUM(point) AS total FROM points GROUP BY user_id) AS ledger
+        LEFT JOIN balances ON balances.user_id = ledger.user_id
+        WHERE balances.balance IS NOT ledger.total
+        UNION ALL
+        SELECT user_id, 0, balance FROM balances
+        WHERE balance != 0 AND user_id NOT IN (SELECT user_id FROM points)
+    """).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def _enqueue_notification(conn, user_id, messages):
+    now = time.time()
+    payload = json.dumps(messages, ensure_ascii=False)
+    metrics.observe('db_payload_bytes', len(payload.encode()), buckets=metrics.SIZE_BUCKETS, op='enqueue_notification')
+    conn.execute(
+        'INSERT INTO notifications (user_id, messages, next_attempt_at, created_at) VALUES (?, ?, ?, ?)',
+        (user_id, payload, now, now),
+    )
+
+
+@metrics.timer('db_seconds', op='enqueue_notification')
+def enqueue_notification(user_id, messages):
+    with transaction() as conn:
+        _enqueue_notification(conn, user_id, messages)
+
+
+@metrics.timer('db_seconds', op='due_notifications')
+def due_notifications(now, limit):
+    conn = connect()
+    rows = conn.execute(
+        "SELECT seq, user_id, messages, attempts, retry_key FROM notifications "
+        "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY seq LIMIT ?",
+        (now, limit),
+    ).fetchall()
+    # 帶著 retry key 的通知要整批用同一個 key 重送，LIMIT 切到一半時把同批的其他通知補上
+    keys = sorted({row["retry_key"] for row in rows if row["retry_key"]})
+    if keys:
+        seqs = {row["seq"] for row in rows}
+        rows += [row for row in conn.execute(
+            "SELECT seq, user_id, messages, attempts, retry_key FROM notifications "
+            "WHERE status = 'pending' AND retry_key IN (SELECT value FROM json_each(?)) ORDER BY seq",
+            (json.dumps(keys),),
+        ).fetchall() if row["seq"] not in seqs]
+    return [dict(row, messages=json.loads(row["messages"])) for row in rows]
+
+
+def mark_notifications_sent(seqs):
+    with transaction() as conn:
+        conn.executemany("UPDATE notifications SET status = 'sent' WHERE seq = ?", [(x,) for x in seqs])
+
+
+def reschedule_notifications(seqs, error, next_attempt_at, retry_key):
+    """Queue a failed batch again; it is resent as one request carrying the same retry_key."""
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE notifications SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, retry_key = ? "
+            "WHERE seq = ?",
+            [(error, next_attempt_at, retry_key, x) for x in seqs],
+        )
+
+
+def fail_notifications(seqs, error):
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE notifications SET attempts = attempts + 1, last_error = ?, status = 'failed' WHERE seq = ?",
+            [(error, x) for x in seqs],
+        )
+
+
+def prune_notifications(before):
+    connect().execute("DELETE FROM notifications WHERE status = 'sent' AND created_at < ?", (before,))
+
+
+def notification_counts():
+    rows = connect().execute('SELECT status, COUNT(*) FROM notifications GROUP BY status').fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+WEBHOOK_EVENT_TTL = 24 * 60 * 60
+
+
+@metrics.timer('db_seconds', op='mark_webhook_event')
+def mark_webhook_event(event_id):
+    """Record a webhook event id; returns False when it was already seen by any worker."""
+    now = time.time()
+    conn = connect()
+    inserted = conn.execute(
+        'INSERT OR IGNORE INTO webhook_events (id, received_at) VALUES (?, ?)',
+        (event_id, now),
+    ).rowcount == 1
+    # LINE 重送的期限遠短於一天，順手清掉舊的紀錄
+    if inserted and random.random() < 0.01:
+        conn.execute('DELETE FROM webhook_events WHERE received_at < ?', (now - WEBHOOK_EVENT_TTL,))
+    return inserted
+
+
+def forget_webhook_event(event_id):
+    connect().execute('DELETE FROM webhook_events WHERE id = ?', (event_id,))
+
+
+def get_card_cache(user_id):
+    row = connect().execute(
+        'SELECT user_id, key, size, accessed_at FROM card_cache WHERE user_id = ?',
+        (user_id,),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def touch_card_cache(user_id, accessed_at):
+    connect().execute('UPDATE card_cache SET accessed_at = ? WHERE user_id = ?', (accessed_at, user_id))
+
+
+def _card_cache_size(conn, user_id):
+    row = conn.execute('SELECT size FROM card_cache WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def put_card_cache(user_id, key, size, accessed_at):
+    with transaction() as conn:
+        delta = size - _card_cache_size(conn, user_id)
+        conn.execute(
+            'INSERT INTO card_cache (user_id, key, size, accessed_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET key = excluded.key, size = excluded.size, '
+            'accessed_at = excluded.accessed_at',
+            (user_id, key, size, accessed_at),
+        )
+        conn.execute('UPDATE card_cache_size SET size = size + ? WHERE id = 0', (delta,))
+
+
+def delete_card_cache(user_id):
+    with transaction() as conn:
+        size = _card_cache_size(conn, user_id)
+        conn.execute('DELETE FROM card_cache WHERE user_id = ?', (user_id,))
+        conn.execute('UPDATE card_cache_size SET size = size - ? WHERE id = 0', (size,))
+
+
+def card_cache_total_size():
+    row = connect().execute('SELECT size FROM card_cache_size WHERE id = 0').fetchone()
+    return row[0] if row else 0
+
+
+def least_recent_card_cache(limit):
+    rows = connect().execute(
+        'SELECT user_id, key, size, accessed_at FROM card_cache ORDER BY accessed_at LIMIT ?',
+        (limit,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _load_json(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def _legacy_order_items(order):
+    # 舊的管理頁面把 <select> 的值直接存進去，數量會是字串；比照 orders.normalize_items 轉成整數
+    try:
+        return [{"id": x["id"], "qty": int(x["qty"])} for x in order["items"]]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"order {order.get('id')}: invalid items ({e})")
+
+
+def migrate_json(static_dir='static'):
+    users = _load_json(os.path.join(static_dir, 'users.json'))
+    items = _load_json(os.path.join(static_dir, 'item.json'))
+    orders = _load_json(os.path.join(static_dir, 'order.json'))
+    points = _load_json(os.path.join(static_dir, 'point.json'))
+
+    # 舊的訂單沒有 created_at，改用對應積點紀錄的時間
+    order_created_at = {x["order_id"]: x["created_at"] for x in points if x.get("order_id")}
+
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, name) VALUES (:id, :name)',
+            users,
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO items (id, name, image, price) VALUES (?, ?, ?, ?)',
+            [(x["id"], x["name"], x["image"], int(x["price"])) for x in items],
+        )
+        _bump_version(conn, 'items')
+        conn.executemany(
+            'INSERT OR IGNORE INTO orders (id, user_id, items, total, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(x["id"], x["user_id"], json.dumps(_legacy_order_items(x)), int(x["total"]),
+              order_created_at.get(x["id"])) for x in orders],
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO points (id, user_id, description, order_id, point, created_at) '
+            'VALUES (:id, :user_id, :description, :order_id, :point, :created_at)',
+            points,
+        )
+        _rebuild_balances(conn)
+        _rebuild_sales(conn)
+
+    return {
+        "users": len(users),
+        "items": len(items),
+        "orders": len(orders),
+        "points": len(points),
+    }
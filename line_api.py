@@ -0,0 +1,114 @@
+import functools
+import os
+import threading
+import time
+
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    ApiException,
+    MessagingApi,
+    MessagingApiBlob,
+)
+from urllib3.util.retry import Retry
+
+import metrics
+
+LINE_API_HOST = os.environ.get('LINE_API_HOST', 'https://api.line.me')
+# 圖片等二進位資料走 api-data.line.me，SDK 寫死了網址，測試時用這個換成本機的 stub
+DEFAULT_DATA_HOST = 'https://api-data.line.me'
+LINE_API_DATA_HOST = os.environ.get('LINE_API_DATA_HOST', DEFAULT_DATA_HOST)
+LINE_API_TIMEOUT = (3.05, 10)
+LINE_API_POOL_SIZE = int(os.environ.get('LINE_API_POOL_SIZE', os.environ.get('WEBHOOK_WORKERS', 4)))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+class InstrumentedApi:
+    """Wraps a generated LINE API class, adding a default timeout and per-method latency metrics."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            kwargs.setdefault('_request_timeout', LINE_API_TIMEOUT)
+            method = name[:-len('_with_http_info')] if name.endswith('_with_http_info') else name
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+                status = str(getattr(result, 'status_code', 200))
+                return result
+            except ApiException as e:
+                status = str(e.status)
+                raise
+            finally:
+                metrics.observe('line_api_seconds', time.perf_counter() - start, method=method)
+                metrics.inc('line_api_requests_total', method=method, status=status)
+
+        return call
+
+
+class DataHostApiClient(ApiClient):
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(DEFAULT_DATA_HOST):
+            url = LINE_API_DATA_HOST + url[len(DEFAULT_DATA_HOST):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def configuration():
+    config = Configuration(
+        host=LINE_API_HOST,
+        access_token=os.environ.get('LINE_CHANNEL_ACCESS_TOKEN'),
+    )
+    config.connection_pool_maxsize = LINE_API_POOL_SIZE
+    return config
+
+
+def _build_client():
+    config = configuration()
+    # 429 與 5xx 以指數退避重試，並遵守 Retry-After
+    config.retries = Retry(
+        total=3,
+        connect=2,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    return DataHostApiClient(config)
+
+
+def api_client():
+    """Return the long-lived ApiClient of this process; it is created after uwsgi forks."""
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = _build_client()
+            _client_pid = os.getpid()
+        return _client
+
+
+def messaging_api():
+    return InstrumentedApi(MessagingApi(api_client()))
+
+
+def messaging_api_blob():
+    return InstrumentedApi(MessagingApiBlob(api_client()))
+
+
+def insight_api():
+    # 好友人數等統計資料在另一個套件，有自己的 ApiClient；只有通知 worker 會用到
+    from linebot.v3.insight import ApiClient as InsightApiClient, Configuration as InsightConfiguration, Insight
+
+    config = InsightConfiguration(host=LINE_API_HOST, access_token=os.environ.get('LINE_CHANNEL_ACCESS_TOKEN'))
+    return InstrumentedApi(Insight(InsightApiClient(config)))
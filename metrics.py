@@ -0,0 +1,257 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# 每個 process 定期把自己的數據寫到這個目錄，/metrics 再把所有檔案加總
+METRICS_DIR = os.environ.get('METRICS_DIR', 'data/metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# 已結束的 process 的數據併進這個檔案，counter 不會因為 worker 重啟而倒退，目錄也不會越積越多
+ARCHIVE_NAME = '_exited.json'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_flusher_pid = None
+# pid 會被重複使用，檔名再加上每個 process 自己的亂數
+_instance = uuid.uuid4().hex[:8]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _ensure_flusher()
+
+
+def observe(name, value, buckets=BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"bounds": list(buckets), "buckets": [0] * len(buckets),
+                                            "sum": 0.0, "count": 0}
+        for i, bound in enumerate(histogram["bounds"]):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+    _ensure_flusher()
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    with _lock:
+        return {
+            "counters": [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, dict(labels), dict(h, buckets=list(h["buckets"]))]
+                           for (name, labels), h in _histograms.items()],
+        }
+
+
+def _snapshot_path():
+    return os.path.join(METRICS_DIR, f"{os.getpid()}-{_instance}.json")
+
+
+def _snapshot_pid(path):
+    try:
+        return int(os.path.basename(path).split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _exited(pid):
+    # 跟自己同 pid 但不是自己的檔案，是 pid 被重複使用前那個 process 留下的
+    if pid is None:
+        return False
+    return pid == os.getpid() or not _alive(pid)
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(counters, histograms, data):
+    for name, labels, value in data["counters"]:
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, h in data["histograms"]:
+        key = _key(name, labels)
+        total = histograms.get(key)
+        if total is None:
+            histograms[key] = dict(h, buckets=list(h["buckets"]))
+            continue
+        total["buckets"] = [a + b for a, b in zip(total["buckets"], h["buckets"])]
+        total["sum"] += h["sum"]
+        total["count"] += h["count"]
+
+
+def _write(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _retire(paths):
+    """Fold the snapshots of exited processes into the archive and delete them."""
+    if not paths:
+        return
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock:
+        # 多個 worker 同時被 scrape 時只能有一個在合併，否則會重複加總
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(METRICS_DIR, ARCHIVE_NAME)
+        counters, histograms = {}, {}
+        archive = _load(archive_path)
+        if archive is not None:
+            _merge(counters, histograms, archive)
+        retired = []
+        for path in paths:
+            data = _load(path)
+            if data is not None:
+                _merge(counters, histograms, data)
+                retired.append(path)
+        if not retired:
+            return
+        _write(archive_path, {
+            "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, dict(labels), h] for (name, labels), h in histograms.items()],
+        })
+        for path in retired:
+            os.remove(path)
+
+
+def flush():
+    """Write this process's metrics where other processes can aggregate them."""
+    if not os.path.exists(METRICS_DIR):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+    _write(_snapshot_path(), snapshot())
+
+
+def _flush_forever():
+    # 同一個 pid 的其他檔案一定屬於已經結束的 process
+    try:
+        if os.path.exists(METRICS_DIR):
+            own = _snapshot_path()
+            _retire([path for path in glob.glob(os.path.join(METRICS_DIR, f"{os.getpid()}-*.json")) if path != own])
+    except OSError:
+        pass
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def _ensure_flusher():
+    # uwsgi worker 與會員卡 process pool 都是 fork 出來的，各自啟動一條 thread
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_forever, daemon=True).start()
+
+
+def _reset_after_fork():
+    # fork 出來的 process 從零開始計數，否則父行程的數據會被重複加總
+    global _lock, _instance
+    _lock = threading.Lock()
+    _instance = uuid.uuid4().hex[:8]
+    _counters.clear()
+    _histograms.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def aggregate():
+    """Sum the snapshots written by every process, with this process's live values."""
+    own = _snapshot_path()
+    paths = glob.glob(os.path.join(METRICS_DIR, "*.json"))
+    exited = [path for path in paths if path != own and _exited(_snapshot_pid(path))]
+    if exited:
+        try:
+            _retire(exited)
+        except OSError:
+            pass
+        paths = glob.glob(os.path.join(METRICS_DIR, "*.json"))
+
+    snapshots = {}
+    for path in paths:
+        data = _load(path)
+        if data is not None:
+            snapshots[path] = data
+    snapshots[own] = snapshot()
+
+    counters, histograms = {}, {}
+    for data in snapshots.values():
+        _merge(counters, histograms, data)
+    return counters, histograms
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render():
+    """Render the aggregated metrics in the Prometheus text exposition format."""
+    counters, histograms = aggregate()
+    lines = []
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        for bound, count in zip(h["bounds"], h["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {h['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {h['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {h['count']}")
+    return "\n".join(lines) + "\n"
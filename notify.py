@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from linebot.v3.insight import ApiException as InsightApiException
+from linebot.v3.messaging import (
+    ApiException,
+    Message,
+    MulticastRequest,
+    NarrowcastRequest,
+    PushMessageRequest,
+)
+
+import db
+import line_api
+import metrics
+
+# 同一個請求最多 5 則訊息，multicast 一次最多 500 人
+MAX_MESSAGES = 5
+MULTICAST_SIZE = 500
+BROADCAST = '*'
+
+NOTIFY_RATE = float(os.environ.get('NOTIFY_RATE', 20))
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', 2000))
+NOTIFY_POLL_INTERVAL = float(os.environ.get('NOTIFY_POLL_INTERVAL', 1))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 8))
+NOTIFY_RETENTION = 7 * 24 * 60 * 60
+QUOTA_REFRESH = 60
+# 好友人數統計一天更新一次
+AUDIENCE_REFRESH = 6 * 60 * 60
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(user_id, messages):
+    """Queue messages (LINE message objects) to be pushed to one user."""
+    db.enqueue_notification(user_id, [m.to_dict() for m in messages])
+
+
+def broadcast(messages):
+    """Queue messages for every friend of the channel, sent with narrowcast."""
+    db.enqueue_notification(BROADCAST, [m.to_dict() for m in messages])
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class Quota:
+    """Remaining messages this month, refreshed from the quota API every QUOTA_REFRESH seconds."""
+
+    def __init__(self, api, insight):
+        self.api = api
+        self.insight = insight
+        self.remaining = None
+        self.refreshed = 0
+        self.audience = None
+        self.audience_refreshed = 0
+
+    def broadcast_recipients(self):
+        """Estimate how many friends a narrowcast to everyone reaches."""
+        if time.time() - self.audience_refreshed > AUDIENCE_REFRESH:
+            self.audience_refreshed = time.time()
+            # 統計以 UTC+9 的日期計算，最新只到前一天
+            day = time.strftime('%Y%m%d', time.gmtime(time.time() + 9 * 60 * 60 - 24 * 60 * 60))
+            try:
+                followers = self.insight.get_number_of_followers(var_date=day)
+            except InsightApiException:
+                logger.warning('Cannot get the number of followers for %s', day)
+            else:
+                if followers.status == 'ready':
+                    self.audience = followers.targeted_reaches
+        # 還沒有統計資料時以會員人數估計
+        return self.audience if self.audience is not None else db.count_users()
+
+    def allows(self, recipients):
+        if time.time() - self.refreshed > QUOTA_REFRESH:
+            quota = self.api.get_message_quota()
+            if quota.type == 'limited':
+                usage = self.api.get_message_quota_consumption().total_usage
+                self.remaining = quota.value - usage
+            else:
+                self.remaining = None
+            self.refreshed = time.time()
+        return self.remaining is None or self.remaining >= recipients
+
+    def consume(self, recipients):
+        if self.remaining is not None:
+            self.remaining -= recipients
+
+
+def coalesce(rows):
+    """Merge queued rows per user into at most MAX_MESSAGES messages; returns {user_id: (seqs, messages)}."""
+    batches = {}
+    for row in rows:
+        seqs, messages = batches.setdefault(row["user_id"], ([], []))
+        if len(messages) + len(row["messages"]) > MAX_MESSAGES and messages:
+            # 放不下的留到下一輪
+            continue
+        seqs.append(row["seq"])
+        messages.extend(row["messages"][:MAX_MESSAGES])
+    return batches
+
+
+def replan(rows):
+    """Rebuild the calls of rows that failed before, one per retry key, exactly as they were first sent."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row["retry_key"], []).append(row)
+
+    calls = []
+    for retry_key, group in groups.items():
+        batches = coalesce(group)
+        users = list(batches)
+        messages = batches[users[0]][1]
+        seqs = [x for user_seqs, _ in batches.values() for x in user_seqs]
+        if users == [BROADCAST]:
+            calls.append(("narrowcast", None, messages, seqs, retry_key))
+        else:
+            calls.append(("push" if len(users) == 1 else "multicast", users, messages, seqs, retry_key))
+    return calls
+
+
+def plan(batches):
+    """Group users receiving identical messages so they can share one multicast call."""
+    groups = {}
+    for user_id, (seqs, messages) in batches.items():
+        key = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+        group = groups.setdefault(key, {"messages": messages, "users": [], "seqs": []})
+        group["users"].append(user_id)
+        group["seqs"].append(seqs)
+
+    calls = []
+    for group in groups.values():
+        users, seqs = group["users"], group["seqs"]
+        if BROADCAST in users:
+            i = users.index(BROADCAST)
+            calls.append(("narrowcast", None, group["messages"], seqs.pop(i)))
+            users.pop(i)
+        for start in range(0, len(users), MULTICAST_SIZE):
+            chunk = users[start:start + MULTICAST_SIZE]
+            chunk_seqs = [x for s in seqs[start:start + MULTICAST_SIZE] for x in s]
+            method = "push" if len(chunk) == 1 else "multicast"
+            calls.append((method, chunk, group["messages"], chunk_seqs))
+    return calls
+
+
+class Notifier:
+    def __init__(self, rate=NOTIFY_RATE):
+        self.api = line_api.messaging_api()
+        self.limiter = RateLimiter(rate)
+        self.quota = Quota(self.api, line_api.insight_api())
+        self.last_prune = 0
+
+    def send(self, method, users, messages, retry_key):
+        messages = [Message.from_dict(m) for m in messages]
+        if method == "push":
+            self.api.push_message(PushMessageRequest(to=users[0], messages=messages), x_line_retry_key=retry_key)
+        elif method == "multicast":
+            self.api.multicast(MulticastRequest(to=users, messages=messages), x_line_retry_key=retry_key)
+        else:
+            self.api.narrowcast(NarrowcastRequest(messages=messages), x_line_retry_key=retry_key)
+
+    def _sent(self, method, seqs, recipients):
+        db.mark_notifications_sent(seqs)
+        self.quota.consume(recipients)
+        metrics.inc('notify_sent_total', method=method)
+        metrics.inc('notify_recipients_total', recipients, method=method)
+
+    def _retry_later(self, seqs, attempts, error, retry_key):
+        attempt = max(attempts[x] for x in seqs) + 1
+        # 整批一起放棄，不能只重送其中一部分
+        if attempt >= NOTIFY_MAX_ATTEMPTS:
+            db.fail_notifications(seqs, error)
+        else:
+            db.reschedule_notifications(seqs, error, time.time() + min(3600, 5 * 2 ** (attempt - 1)), retry_key)
+
+    def run_once(self):
+        """Send every due notification once; returns the number of queued rows handled."""
+        rows = db.due_notifications(time.time(), NOTIFY_BATCH_SIZE)
+        if not rows:
+            return 0
+
+        attempts = {row["seq"]: row["attempts"] for row in rows}
+        # 失敗過的整批用原本的 retry key 重送，LINE 已經收下的請求就不會再送一次
+        retried = [row for row in rows if row["retry_key"]]
+        calls = replan(retried) + [call + (str(uuid.uuid4()),) for call in
+                                   plan(coalesce([row for row in rows if not row["retry_key"]]))]
+        retry_keys = {row["retry_key"] for row in retried}
+        handled = 0
+        for method, users, messages, seqs, retry_key in calls:
+            recipients = len(users) if users else self.quota.broadcast_recipients()
+            if not self.quota.allows(recipients):
+                metrics.inc('notify_quota_exhausted_total')
+                logger.warning('Message quota exhausted, keeping %d notifications queued', len(seqs))
+                continue
+
+            self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                self.send(method, users, messages, retry_key)
+            except ApiException as e:
+                if e.status == 409 and retry_key in retry_keys:
+                    # 409 表示這個 retry key 的請求先前已經被接受，只是當時沒收到回應
+                    self._sent(method, seqs, recipients)
+                elif e.status in RETRY_STATUS:
+                    metrics.inc('notify_failed_total', method=method, status=str(e.status))
+                    self._retry_later(seqs, attempts, f"{e.status} {e.reason}", retry_key)
+                else:
+                    metrics.inc('notify_failed_total', method=method, status=str(e.status))
+                    db.fail_notifications(seqs, f"{e.status} {e.reason}")
+            except Exception as e:
+                # 連線錯誤、逾時等情況視為暫時性失敗，LINE 可能已經收到了
+                metrics.inc('notify_failed_total', method=method, status='error')
+                self._retry_later(seqs, attempts, repr(e), retry_key)
+            else:
+                self._sent(method, seqs, recipients)
+            finally:
+                metrics.observe('notify_send_seconds', time.perf_counter() - start, method=method)
+            handled += len(seqs)
+
+        if time.time() - self.last_prune > 3600:
+            db.prune_notifications(time.time() - NOTIFY_RETENTION)
+            self.last_prune = time.time()
+        return handled
+
+    def run_forever(self, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                handled = self.run_once()
+            except Exception:
+                logger.exception('Notification worker failed, retrying')
+                handled = 0
+            if not handled:
+                stop.wait(NOTIFY_POLL_INTERVAL)
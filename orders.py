@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from math import floor
+from uuid import uuid4
+
+import catalog
+import db
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_BULK_ORDERS = 1000
+# 訂單時間以店家所在的時區記錄，營業日統計才不會跟著伺服器 (Docker 預設 UTC) 的時區跑
+BUSINESS_UTC_OFFSET = float(os.environ.get('BUSINESS_UTC_OFFSET', 8))
+BUSINESS_TIMEZONE = timezone(timedelta(hours=BUSINESS_UTC_OFFSET))
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidOrder(Exception):
+    pass
+
+
+def business_day():
+    """Return today's date (YYYY-MM-DD) in the business time zone."""
+    return datetime.now(BUSINESS_TIMEZONE).date().isoformat()
+
+
+def normalize_items(items, catalog_items):
+    """Return [{"id", "qty"}] with integer quantities; raises InvalidOrder for unknown items or bad quantities."""
+    if not isinstance(items, list) or not items:
+        raise InvalidOrder('no items')
+
+    normalized = []
+    for x in items:
+        if not isinstance(x, dict) or catalog_items.get(x.get("id")) is None:
+            raise InvalidOrder('unknown item')
+        # 掃描頁面送來的數量是字串；1.7 這種小數不能直接截成 1
+        raw_qty = x.get("qty")
+        if isinstance(raw_qty, float) and not raw_qty.is_integer():
+            raise InvalidOrder('invalid quantity')
+        try:
+            qty = int(raw_qty)
+        except (TypeError, ValueError):
+            raise InvalidOrder('invalid quantity')
+        if qty <= 0:
+            raise InvalidOrder('invalid quantity')
+        normalized.append({"id": x["id"], "qty": qty})
+    return normalized
+
+
+def order_total(items, catalog_items):
+    try:
+        return sum(int(catalog_items.get(x["id"])["price"]) * x["qty"] for x in items)
+    except (TypeError, ValueError):
+        raise InvalidOrder('invalid item price')
+
+
+def build_order(user_id, items, catalog_items, submitted_total=None):
+    """Return (order, point_record, notification) with the total recomputed from the catalog."""
+    if not user_id:
+        raise InvalidOrder('missing user')
+    items = normalize_items(items, catalog_items)
+    total = order_total(items, catalog_items)
+    if submitted_total is not None and submitted_total != total:
+        logger.warning('Order for %s submitted total %r, catalog total is %d', user_id, submitted_total, total)
+
+    order = {
+        "id": str(uuid4()),
+        "user_id": user_id,
+        "items": items,
+        "total": total,
+        "created_at": datetime.now(BUSINESS_TIMEZONE).isoformat(),
+    }
+
+    point_record = {
+        "id": str(uuid4()),
+        "user_id": user_id,
+        "description": f"消費 {total} 元，獲得 {floor(total / 10)} 點",
+        "order_id": order["id"],
+        "point": floor(total / 10),
+        "created_at": order["created_at"],
+    }
+
+    from linebot.v3.messaging import TextMessage
+
+    notification = [TextMessage(text=f"感謝您的消費！{point_record['description']}").to_dict()]
+    return order, point_record, notification
+
+
+def _fingerprint(kind, orders):
+    body = [[order["user_id"], order["items"]] for order, _, _ in orders]
+    return hashlib.sha256(json.dumps([kind, body], sort_keys=True).encode()).hexdigest()
+
+
+def create_order(user_id, items, total=None, idempotency_key=None):
+    """Store an order with its point record; raises InvalidOrder for unknown items.
+
+    A retry carrying the same idempotency_key returns the order stored the first time.
+    """
+    entry = build_order(user_id, items, catalog.get_catalog(), total)
+    stored, _ = db.create_orders([entry], idempotency_key, _fingerprint('order', [entry]))
+    return stored[0]
+
+
+def create_orders(payload, idempotency_key=None):
+    """Store many {"userId", "items"} orders in one transaction; nothing is stored if any is invalid."""
+    if not isinstance(payload, list) or not payload:
+        raise InvalidOrder('no orders')
+    if len(payload) > MAX_BULK_ORDERS:
+        raise InvalidOrder(f'at most {MAX_BULK_ORDERS} orders per request')
+
+    catalog_items = catalog.get_catalog()
+    entries = []
+    for i, data in enumerate(payload):
+        if not isinstance(data, dict):
+            raise InvalidOrder(f'order {i}: not an object')
+        try:
+            entries.append(build_order(data.get("userId"), data.get("items"), catalog_items, data.get("total")))
+        except InvalidOrder as e:
+            raise InvalidOrder(f'order {i}: {e}')
+    stored, _ = db.create_orders(entries, idempotency_key, _fingerprint('bulk', entries))
+    return stored
+
+
+def join_order_items(order, items):
+    # inner join name, price
+    order["items"] = list(map(lambda x: {
+        "id": x["id"],
+        "qty": x["qty"],
+        "name": items.get(x["id"])["name"],
+        "price": items.get(x["id"])["price"],
+    }, order["items"]))
+    return order
+
+
+def join_sales_items(rows, items):
+    # 已下架的品項仍然保留在統計裡，只是沒有名稱
+    for row in rows:
+        item = items.get(row["id"])
+        row["name"] = item["name"] if item is not None else None
+    return rows
+
+
+def clamp_limit(limit):
+    return max(1, min(limit if limit is not None else PAGE_SIZE, MAX_PAGE_SIZE))
@@ -0,0 +1,61 @@
+from urllib.parse import parse_qs
+
+from linebot.v3.messaging import TextMessage, ImageMessage
+
+import assets
+import card
+import storage
+import template
+import users
+
+
+def text_message_replies(event):
+    messages = [template.menu_message]
+    catalog_message = template.catalog_message()
+    if catalog_message is not None:
+        messages.append(catalog_message)
+    return messages
+
+
+def member_card_replies(uid, ready):
+    if ready:
+        return [
+            ImageMessage(
+                original_content_url=storage.versioned_url('card', uid, '.png'),
+                preview_image_url=storage.versioned_url('card', uid, '_preview.jpg')
+            ),
+            ImageMessage(
+                original_content_url=storage.versioned_url('card', uid, '_qr.png'),
+                preview_image_url=storage.versioned_url('card', uid, '_qr.png')
+            )
+        ]
+
+    # 第一次產生會員卡，先回覆樣板圖，背景產生完成後再點一次即可
+    return [
+        ImageMessage(
+            original_content_url=assets.versioned_url("static/card.png"),
+            preview_image_url=assets.versioned_url("static/card.png")
+        ),
+        TextMessage(text='會員卡製作中，請稍後再點一次「會員卡」')
+    ]
+
+
+def postback_replies(event):
+    """Return the reply messages for a postback event, or None when there is nothing to say."""
+    data = parse_qs(event.postback.data)
+    if data.get('action') == ['catalog']:
+        try:
+            page = int(data.get('page', ['1'])[0])
+        except ValueError:
+            page = 1
+        catalog_message = template.catalog_message(page)
+        return [catalog_message] if catalog_message is not None else None
+
+    if event.postback.data == 'action=member_card':
+        uid = event.source.user_id
+        user = users.get_or_create(uid, "未提供")
+        ready = card.card_ready(uid)
+        card.ensure_card(user.name, uid)
+        return member_card_replies(uid, ready)
+
+    return None
@@ -1,110 +1,308 @@
 # -*- coding: utf-8 -*-
-
+# 部署 rich menu。定義與圖片都沒變時不會重新建立，切換 alias 與預設選單後再清掉舊的：
+#
+#   python richmenu.py deploy              # 部署所有選單，沒變的跳過
+#   python richmenu.py gc --dry-run        # 列出不再使用的選單
+#   python richmenu.py link staff          # 把 STAFF_USER_IDS 的使用者綁到員工選單
+#   python richmenu.py link member --users-file ids.txt
+#
+# LINE_API_HOST / LINE_API_DATA_HOST 指向 benchmarks/stub_line.py 即可在本機測試
+import argparse
+import hashlib
+import io
+import json
 import os
+import re
 import sys
 
 from dotenv import load_dotenv
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    MessagingApiBlob,
-    RichMenuRequest,
+
+load_dotenv()
+
+from linebot.v3.messaging import (  # noqa: E402
+    ApiException,
+    CreateRichMenuAliasRequest,
+    PostbackAction,
     RichMenuArea,
-    RichMenuSize,
     RichMenuBounds,
+    RichMenuBulkLinkRequest,
+    RichMenuRequest,
+    RichMenuSize,
+    UpdateRichMenuAliasRequest,
     URIAction,
-    RichMenuSwitchAction,
-    CreateRichMenuAliasRequest, PostbackAction
 )
 
-load_dotenv()
+import line_api  # noqa: E402
+import notify  # noqa: E402
 
-channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
-if channel_access_token is None:
-    print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
-    sys.exit(1)
+# LINE 對 rich menu 圖片的上限
+MAX_IMAGE_BYTES = 1024 * 1024
+JPEG_QUALITIES = (90, 80, 70, 60, 50)
+# 圖片寬度最小 800px
+DOWNSCALE_WIDTHS = (2000, 1600, 1200, 800)
+# bulk link API 一次最多 500 人
+BULK_LINK_SIZE = 500
+BULK_LINK_RATE = float(os.environ.get('RICHMENU_LINK_RATE', 2))
+STAFF_USER_IDS = [uid for uid in os.environ.get('STAFF_USER_IDS', '').split(',') if uid]
+ADMIN_URL = os.environ.get('ADMIN_URL', 'https://test-linebot.hsuan.app/admin')
+# 這個工具建立的選單名稱是 <segment>-<雜湊>，舊版腳本建立的叫 richmenu-basic
+MANAGED_NAME = re.compile(r'^(?:[a-z]+-[0-9a-f]{16}|richmenu-basic)$')
+
+
+def _area(x, y, width, height, action):
+    return RichMenuArea(bounds=RichMenuBounds(x=x, y=y, width=width, height=height), action=action)
+
+
+def _member_card_action():
+    return PostbackAction(label='會員卡', displayText='顯示會員卡', data='action=member_card')
+
+
+def member_menu():
+    return RichMenuRequest(
+        size=RichMenuSize(width=2500, height=1686),
+        selected=True,
+        name='member',
+        chat_bar_text='查看更多資訊',
+        areas=[
+            _area(0, 0, 1250, 1686, URIAction(uri="https://liff.line.me/2001486622-g5oK1pGe")),
+            _area(1251, 0, 1250, 843, _member_card_action()),
+            _area(1251, 844, 2500, 843, URIAction(uri="https://liff.line.me/2001486622-5ZB1OzmV")),
+        ],
+    )
+
+
+def staff_menu():
+    return RichMenuRequest(
+        size=RichMenuSize(width=2500, height=1686),
+        selected=True,
+        name='staff',
+        chat_bar_text='管理選單',
+        areas=[
+            _area(0, 0, 1250, 1686, URIAction(uri=ADMIN_URL)),
+            _area(1251, 0, 1250, 843, _member_card_action()),
+            _area(1251, 844, 1249, 842, URIAction(uri=f"{ADMIN_URL}/items")),
+        ],
+    )
+
+
+MENUS = {
+    'member': {"build": member_menu, "image": 'static/menu.png', "alias": 'richmenu-alias-a', "default": True},
+    'staff': {"build": staff_menu, "image": os.environ.get('RICHMENU_STAFF_IMAGE', 'static/menu.png'),
+              "alias": 'richmenu-alias-staff', "default": False},
+}
+
+
+def prepare_image(data, width, height):
+    """Return (bytes, content type) of an image that fits LINE's size and byte limits."""
+    from PIL import Image
+
+    import images
+
+    img = Image.open(io.BytesIO(data))
+    if len(data) <= MAX_IMAGE_BYTES and img.size == (width, height) and img.format in ('PNG', 'JPEG'):
+        return data, f"image/{img.format.lower()}"
+
+    # rich menu 不支援透明，先轉成 RGB 再縮放成定義的尺寸
+    img = images.flatten(img)
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', optimize=True)
+    if buffer.tell() <= MAX_IMAGE_BYTES:
+        return buffer.getvalue(), 'image/png'
+    # 先降 JPEG 品質，還是太大就縮小尺寸，LINE 會依選單大小縮放圖片
+    for scaled_width in (width,) + tuple(w for w in DOWNSCALE_WIDTHS if w < width):
+        scaled = img if scaled_width == width else img.resize(
+            (scaled_width, round(height * scaled_width / width)), Image.LANCZOS)
+        for quality in JPEG_QUALITIES:
+            buffer = io.BytesIO()
+            scaled.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+            if buffer.tell() <= MAX_IMAGE_BYTES:
+                return buffer.getvalue(), 'image/jpeg'
+    raise SystemExit(f"cannot compress the rich menu image under {MAX_IMAGE_BYTES} bytes")
 
-configuration = Configuration(
-    access_token=channel_access_token
-)
+
+def menu_digest(menu, image):
+    definition = json.dumps(menu.to_dict(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(definition.encode() + image).hexdigest()
+
+
+def _alias_target(api, alias):
+    try:
+        return api.get_rich_menu_alias(alias).rich_menu_id
+    except ApiException as e:
+        if e.status in (400, 404):
+            return None
+        raise
+
+
+def _default_menu(api):
+    try:
+        return api.get_default_rich_menu_id().rich_menu_id
+    except ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def deploy(segment, api, blob_api, dry_run=False):
+    """Create the segment's menu unless an identical one exists, then point its alias at it."""
+    spec = MENUS[segment]
+    menu = spec["build"]()
+    with open(spec["image"], 'rb') as f:
+        source = f.read()
+    # 雜湊原始圖片與定義，沒變時連壓縮都不用做
+    menu.name = f"{segment}-{menu_digest(menu, source)[:16]}"
+
+    existing = {m.name: m.rich_menu_id for m in api.get_rich_menu_list().richmenus}
+    rich_menu_id = existing.get(menu.name)
+    if rich_menu_id:
+        print(f"{segment}: {menu.name} unchanged ({rich_menu_id})")
+    elif dry_run:
+        print(f"{segment}: would create {menu.name}")
+        return None
+    else:
+        image, content_type = prepare_image(source, menu.size.width, menu.size.height)
+        rich_menu_id = api.create_rich_menu(rich_menu_request=menu).rich_menu_id
+        blob_api.set_rich_menu_image(rich_menu_id=rich_menu_id, body=bytearray(image),
+                                     _headers={'Content-Type': content_type})
+        print(f"{segment}: created {menu.name} ({rich_menu_id}, {len(image)} bytes {content_type})")
+
+    current = _alias_target(api, spec["alias"])
+    if current != rich_menu_id and not dry_run:
+        if current is None:
+            api.create_rich_menu_alias(CreateRichMenuAliasRequest(rich_menu_alias_id=spec["alias"],
+                                                                  rich_menu_id=rich_menu_id))
+        else:
+            api.update_rich_menu_alias(spec["alias"], UpdateRichMenuAliasRequest(rich_menu_id=rich_menu_id))
+        print(f"{segment}: alias {spec['alias']} -> {rich_menu_id}")
+        # 非預設的選單是逐一綁定到使用者身上，要改綁到新選單，舊的才能被 gc 刪掉
+        if current is not None and not spec["default"]:
+            link(segment, api, segment_user_ids(segment))
+    if spec["default"] and _default_menu(api) != rich_menu_id and not dry_run:
+        api.set_default_rich_menu(rich_menu_id=rich_menu_id)
+        print(f"{segment}: set as default")
+    return rich_menu_id
+
+
+def _linked_menus(api, segment):
+    """Return {rich menu id: number of users} of the menus the segment's users are linked to."""
+    linked = {}
+    for uid in segment_user_ids(segment):
+        try:
+            rich_menu_id = api.get_rich_menu_id_of_user(uid).rich_menu_id
+        except ApiException as e:
+            if e.status == 404:
+                continue
+            raise
+        linked[rich_menu_id] = linked.get(rich_menu_id, 0) + 1
+    return linked
+
+
+def collect_garbage(api, dry_run=False):
+    """Delete menus created by this tool that no alias, the default menu or a linked user points at."""
+    in_use = {alias.rich_menu_id for alias in api.get_rich_menu_alias_list().aliases}
+    in_use.add(_default_menu(api))
+    candidates = [menu for menu in api.get_rich_menu_list().richmenus
+                  if menu.rich_menu_id not in in_use and MANAGED_NAME.match(menu.name)]
+    linked = {}
+    if candidates:
+        for segment, spec in MENUS.items():
+            if not spec["default"]:
+                for rich_menu_id, count in _linked_menus(api, segment).items():
+                    linked[rich_menu_id] = linked.get(rich_menu_id, 0) + count
+
+    removed = []
+    for menu in candidates:
+        if menu.rich_menu_id in linked:
+            # 刪掉的話這些使用者會掉回預設選單，先用 link 改綁
+            print(f"skipping {menu.name} ({menu.rich_menu_id}): still linked to {linked[menu.rich_menu_id]} users, "
+                  f"run `richmenu.py link` first", file=sys.stderr)
+            continue
+        if not dry_run:
+            api.delete_rich_menu(menu.rich_menu_id)
+        removed.append(menu.rich_menu_id)
+        print(f"{'would delete' if dry_run else 'deleted'} {menu.name} ({menu.rich_menu_id})")
+    return removed
+
+
+def segment_user_ids(segment, users_file=None):
+    if users_file:
+        with (sys.stdin if users_file == '-' else open(users_file)) as f:
+            yield from (line.strip() for line in f if line.strip())
+    elif segment == 'staff':
+        yield from STAFF_USER_IDS
+    else:
+        import db
+
+        staff = set(STAFF_USER_IDS)
+        yield from (user["id"] for user in db.iter_users() if user["id"] not in staff)
+
+
+def _batches(user_ids, size):
+    batch = []
+    for uid in user_ids:
+        batch.append(uid)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def link(segment, api, user_ids, dry_run=False):
+    """Link users to the segment's menu through the bulk link API, BULK_LINK_SIZE at a time."""
+    rich_menu_id = _alias_target(api, MENUS[segment]["alias"])
+    if rich_menu_id is None:
+        raise SystemExit(f"{segment} has not been deployed yet")
+
+    limiter = notify.RateLimiter(BULK_LINK_RATE)
+    linked = 0
+    for batch in _batches(user_ids, BULK_LINK_SIZE):
+        if not dry_run:
+            limiter.acquire()
+            api.link_rich_menu_id_to_users(RichMenuBulkLinkRequest(rich_menu_id=rich_menu_id, user_ids=batch))
+        linked += len(batch)
+    print(f"{segment}: {'would link' if dry_run else 'linked'} {linked} users to {rich_menu_id}")
+    return linked
 
 
 def main():
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_blob_api = MessagingApiBlob(api_client)
-
-        line_bot_api.delete_rich_menu_alias('richmenu-alias-a')
-
-        # 2. Create rich menu A (richmenu-a)
-        rich_menu_to_a_create = RichMenuRequest(
-            size=RichMenuSize(width=2500,
-                              height=1686),
-            selected=True,
-            name='richmenu-basic',
-            chat_bar_text='查看更多資訊',
-            areas=[
-                RichMenuArea(
-                    bounds=RichMenuBounds(
-                        x=0,
-                        y=0,
-                        width=1250,
-                        height=1686
-                    ),
-                    action=URIAction(
-                        uri="https://liff.line.me/2001486622-g5oK1pGe"
-                    )
-                ),
-                RichMenuArea(
-                    bounds=RichMenuBounds(
-                        x=1251,
-                        y=0,
-                        width=1250,
-                        height=843
-                    ),
-                    action=PostbackAction(
-                        label='會員卡',
-                        displayText='顯示會員卡',
-                        data='action=member_card'
-                    )
-                ),
-                RichMenuArea(
-                    bounds=RichMenuBounds(
-                        x=1251,
-                        y=844,
-                        width=2500,
-                        height=843
-                    ),
-                    action=URIAction(
-                        uri="https://liff.line.me/2001486622-5ZB1OzmV"
-                    )
-                )
-            ]
-        )
-
-        rich_menu_a_id = line_bot_api.create_rich_menu(
-            rich_menu_request=rich_menu_to_a_create
-        ).rich_menu_id
-
-        # 3. Upload image to rich menu A
-        with open('static/menu.png', 'rb') as image:
-            line_bot_blob_api.set_rich_menu_image(
-                rich_menu_id=rich_menu_a_id,
-                body=bytearray(image.read()),
-                _headers={'Content-Type': 'image/png'}
-            )
-
-        line_bot_api.set_default_rich_menu(rich_menu_id=rich_menu_a_id)
-
-        # 7. Create rich menu alias A
-        alias_a = CreateRichMenuAliasRequest(
-            rich_menu_alias_id='richmenu-alias-a',
-            rich_menu_id=rich_menu_a_id
-        )
-        line_bot_api.create_rich_menu_alias(alias_a)
-
-        print('success')
-
-
-main()
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    deploy_parser = subparsers.add_parser('deploy')
+    deploy_parser.add_argument('segments', nargs='*', help=f"default: {' '.join(MENUS)}")
+    deploy_parser.add_argument('--dry-run', action='store_true')
+    deploy_parser.add_argument('--gc', action='store_true', help='delete unused menus afterwards')
+    gc_parser = subparsers.add_parser('gc')
+    gc_parser.add_argument('--dry-run', action='store_true')
+    link_parser = subparsers.add_parser('link')
+    link_parser.add_argument('segment', choices=list(MENUS))
+    link_parser.add_argument('--users-file', help="one user id per line, '-' for stdin")
+    link_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if args.command == 'deploy':
+        unknown = set(args.segments) - set(MENUS)
+        if unknown:
+            parser.error(f"unknown segments: {', '.join(sorted(unknown))}")
+
+    if not os.getenv('LINE_CHANNEL_ACCESS_TOKEN'):
+        print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
+        sys.exit(1)
+
+    api = line_api.messaging_api()
+    if args.command == 'deploy':
+        blob_api = line_api.messaging_api_blob()
+        for segment in args.segments or list(MENUS):
+            deploy(segment, api, blob_api, args.dry_run)
+        if args.gc:
+            collect_garbage(api, args.dry_run)
+    elif args.command == 'gc':
+        collect_garbage(api, args.dry_run)
+    else:
+        link(args.segment, api, segment_user_ids(args.segment, args.users_file), args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import time
+
+import assets
+
+# 每個使用者 / 商品產生的檔案依 key 的雜湊分散到 static/<kind>/ab/cd/ 底下，
+# 避免單一目錄累積上百萬個檔案
+STATIC_DIR = 'static'
+KINDS = ('avatar', 'card', 'item')
+# 依長度排序，較長的後綴先比對
+SUFFIXES = {
+    'avatar': ('',),
+    'card': ('_preview.jpg', '_barcode.png', '_qr.png', '.png'),
+    'item': ('_thumb.jpg', '.jpg', '.png'),
+}
+# 暫存檔與孤立的中間檔超過這個時間才視為殘留
+TMP_MAX_AGE = 60 * 60
+
+
+def shard(key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+
+def path(kind, key, suffix=''):
+    """Return the sharded path of a generated file, e.g. static/card/3f/a2/<uid>_qr.png."""
+    return f"{STATIC_DIR}/{kind}/{shard(key)}/{key}{suffix}"
+
+
+def url(kind, key, suffix=''):
+    return f"{assets.ASSET_HOST}/{path(kind, key, suffix)}"
+
+
+def versioned_url(kind, key, suffix=''):
+    return assets.versioned_url(path(kind, key, suffix))
+
+
+def makedirs(file_path):
+    directory = os.path.dirname(file_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    return file_path
+
+
+def split_name(kind, filename):
+    """Return (key, suffix) for a file name written by this app, or None for anything else."""
+    for suffix in SUFFIXES[kind]:
+        if filename.endswith(suffix) and len(filename) > len(suffix):
+            return filename[:len(filename) - len(suffix)], suffix
+    return None
+
+
+def migrate_url(url):
+    """Return the sharded equivalent of a URL into the old flat layout, or the URL unchanged."""
+    if not url:
+        return url
+    prefix, sep, rest = url.partition(f"/{STATIC_DIR}/")
+    kind, _, filename = rest.partition('/')
+    if not sep or kind not in KINDS or not filename or '/' in filename:
+        return url
+    parts = split_name(kind, filename)
+    if parts is None:
+        return url
+    return f"{prefix}/{path(kind, *parts)}"
+
+
+def _flat_files(kind):
+    directory = f"{STATIC_DIR}/{kind}"
+    if not os.path.isdir(directory):
+        return
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # 預設頭像不屬於任何使用者，留在原地
+            if entry.is_file() and not (kind == 'avatar' and entry.name == 'default.png'):
+                yield entry.name
+
+
+def migrate(dry_run=False):
+    """Move files from the old flat static/<kind>/ layout into shards; returns {kind: moved}."""
+    moved = {}
+    for kind in KINDS:
+        moved[kind] = 0
+        for filename in list(_flat_files(kind)):
+            parts = split_name(kind, filename)
+            if parts is None:
+                continue
+            target = path(kind, *parts)
+            if not dry_run:
+                os.replace(f"{STATIC_DIR}/{kind}/{filename}", makedirs(target))
+            moved[kind] += 1
+    return moved
+
+
+def janitor(now=None, dry_run=False):
+    """Delete QR / barcode / preview files whose card is gone, and stale .tmp files; returns the removed paths."""
+    now = now or time.time()
+    removed = []
+    for dirpath, _, filenames in os.walk(f"{STATIC_DIR}/card"):
+        names = set(filenames)
+        for filename in filenames:
+            parts = split_name('card', filename)
+            if filename.endswith('.tmp'):
+                orphan = True
+            else:
+                # 會員卡本體被淘汰或產生失敗時，留下來的中間檔已經沒有用途
+                orphan = parts is not None and parts[1] != '.png' and f"{parts[0]}.png" not in names
+            if not orphan:
+                continue
+
+            # 正在產生的會員卡會先寫 QR code 與 barcode，太新的檔案不動
+            file_path = os.path.join(dirpath, filename)
+            try:
+                if now - os.path.getmtime(file_path) > TMP_MAX_AGE:
+                    removed.append(file_path)
+            except FileNotFoundError:
+                continue
+
+    if not dry_run:
+        for file_path in removed:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+    return removed
@@ -1,267 +1,151 @@
-flex="""
-{
-  "type": "carousel",
-  "contents": [
-    {
-      "type": "bubble",
-      "body": {
-        "type": "box",
-        "layout": "vertical",
-        "contents": [
-          {
-            "type": "image",
-            "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip1.jpg",
-            "size": "full",
-            "aspectMode": "cover",
-            "aspectRatio": "2:3",
-            "gravity": "top"
-          },
-          {
+import threading
+
+from linebot.v3.messaging import (
+    TemplateMessage, ButtonsTemplate, PostbackAction, FlexMessage, FlexCarousel
+)
+
+import catalog
+
+# LINE 的 carousel 最多 12 個 bubble，超過時最後一格放「更多品項」翻頁
+CAROUSEL_SIZE = 12
+
+
+def item_bubble(item):
+    return {
+        "type": "bubble",
+        "body": {
             "type": "box",
             "layout": "vertical",
             "contents": [
-              {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                  {
-                    "type": "text",
-                    "text": "Brown's T-shirts",
-                    "size": "xl",
-                    "color": "#ffffff",
-                    "weight": "bold"
-                  }
-                ]
-              },
-              {
-                "type": "box",
-                "layout": "baseline",
-                "contents": [
-                  {
-                    "type": "text",
-                    "text": "¥35,800",
-                    "color": "#ebebeb",
-                    "size": "sm",
-                    "flex": 0
-                  },
-                  {
-                    "type": "text",
-                    "text": "¥75,000",
-                    "color": "#ffffffcc",
-                    "decoration": "line-through",
-                    "gravity": "bottom",
-                    "flex": 0,
-                    "size": "sm"
-                  }
-                ],
-                "spacing": "lg"
-              },
-              {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                  {
-                    "type": "filler"
-                  },
-                  {
+                {
+                    "type": "image",
+                    "url": item["image"],
+                    "size": "full",
+                    "aspectMode": "cover",
+                    "aspectRatio": "2:3",
+                    "gravity": "top"
+                },
+                {
                     "type": "box",
-                    "layout": "baseline",
+                    "layout": "vertical",
                     "contents": [
-                      {
-                        "type": "filler"
-                      },
-                      {
-                        "type": "icon",
-                        "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip14.png"
-                      },
-                      {
-                        "type": "text",
-                        "text": "Add to cart",
-                        "color": "#ffffff",
-                        "flex": 0,
-                        "offsetTop": "-2px"
-                      },
-                      {
-                        "type": "filler"
-                      }
+                        {
+                            "type": "box",
+                            "layout": "vertical",
+                            "contents": [
+                                {
+                                    "type": "text",
+                                    "text": item["name"],
+                                    "size": "xl",
+                                    "color": "#ffffff",
+                                    "weight": "bold",
+                                    "wrap": True
+                                }
+                            ]
+                        },
+                        {
+                            "type": "box",
+                            "layout": "baseline",
+                            "contents": [
+                                {
+                                    "type": "text",
+                                    "text": f"${item['price']}",
+                                    "color": "#ebebeb",
+                                    "size": "sm",
+                                    "flex": 0
+                                }
+                            ],
+                            "spacing": "lg"
+                        }
                     ],
-                    "spacing": "sm"
-                  },
-                  {
-                    "type": "filler"
-                  }
-                ],
-                "borderWidth": "1px",
-                "cornerRadius": "4px",
-                "spacing": "sm",
-                "borderColor": "#ffffff",
-                "margin": "xxl",
-                "height": "40px"
-              }
+                    "position": "absolute",
+                    "offsetBottom": "0px",
+                    "offsetStart": "0px",
+                    "offsetEnd": "0px",
+                    "backgroundColor": "#03303Acc",
+                    "paddingAll": "20px",
+                    "paddingTop": "18px"
+                }
             ],
-            "position": "absolute",
-            "offsetBottom": "0px",
-            "offsetStart": "0px",
-            "offsetEnd": "0px",
-            "backgroundColor": "#03303Acc",
-            "paddingAll": "20px",
-            "paddingTop": "18px"
-          },
-          {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-              {
-                "type": "text",
-                "text": "SALE",
-                "color": "#ffffff",
-                "align": "center",
-                "size": "xs",
-                "offsetTop": "3px"
-              }
-            ],
-            "position": "absolute",
-            "cornerRadius": "20px",
-            "offsetTop": "18px",
-            "backgroundColor": "#ff334b",
-            "offsetStart": "18px",
-            "height": "25px",
-            "width": "53px"
-          }
-        ],
-        "paddingAll": "0px"
-      }
-    },
-    {
-      "type": "bubble",
-      "body": {
-        "type": "box",
-        "layout": "vertical",
-        "contents": [
-          {
-            "type": "image",
-            "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip2.jpg",
-            "size": "full",
-            "aspectMode": "cover",
-            "aspectRatio": "2:3",
-            "gravity": "top"
-          },
-          {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-              {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                  {
-                    "type": "text",
-                    "text": "Cony's T-shirts",
-                    "size": "xl",
-                    "color": "#ffffff",
-                    "weight": "bold"
-                  }
-                ]
-              },
-              {
-                "type": "box",
-                "layout": "baseline",
-                "contents": [
-                  {
-                    "type": "text",
-                    "text": "¥35,800",
-                    "color": "#ebebeb",
-                    "size": "sm",
-                    "flex": 0
-                  },
-                  {
-                    "type": "text",
-                    "text": "¥75,000",
-                    "color": "#ffffffcc",
-                    "decoration": "line-through",
-                    "gravity": "bottom",
-                    "flex": 0,
-                    "size": "sm"
-                  }
-                ],
-                "spacing": "lg"
-              },
-              {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                  {
-                    "type": "filler"
-                  },
-                  {
-                    "type": "box",
-                    "layout": "baseline",
-                    "contents": [
-                      {
-                        "type": "filler"
-                      },
-                      {
-                        "type": "icon",
-                        "url": "https://scdn.line-apps.com/n/channel_devcenter/img/flexsnapshot/clip/clip14.png"
-                      },
-                      {
-                        "type": "text",
-                        "text": "Add to cart",
-                        "color": "#ffffff",
-                        "flex": 0,
-                        "offsetTop": "-2px"
-                      },
-                      {
-                        "type": "filler"
-                      }
-                    ],
-                    "spacing": "sm"
-                  },
-                  {
-                    "type": "filler"
-                  }
-                ],
-                "borderWidth": "1px",
-                "cornerRadius": "4px",
-                "spacing": "sm",
-                "borderColor": "#ffffff",
-                "margin": "xxl",
-                "height": "40px"
-              }
-            ],
-            "position": "absolute",
-            "offsetBottom": "0px",
-            "offsetStart": "0px",
-            "offsetEnd": "0px",
-            "backgroundColor": "#9C8E7Ecc",
-            "paddingAll": "20px",
-            "paddingTop": "18px"
-          },
-          {
+            "paddingAll": "0px"
+        }
+    }
+
+
+def more_bubble(page):
+    return {
+        "type": "bubble",
+        "body": {
             "type": "box",
             "layout": "vertical",
             "contents": [
-              {
-                "type": "text",
-                "text": "SALE",
-                "color": "#ffffff",
-                "align": "center",
-                "size": "xs",
-                "offsetTop": "3px"
-              }
+                {
+                    "type": "button",
+                    "action": {
+                        "type": "postback",
+                        "label": "更多品項",
+                        "displayText": "更多品項",
+                        "data": f"action=catalog&page={page}"
+                    },
+                    "style": "primary",
+                    "color": "#03303A"
+                }
             ],
-            "position": "absolute",
-            "cornerRadius": "20px",
-            "offsetTop": "18px",
-            "backgroundColor": "#ff334b",
-            "offsetStart": "18px",
-            "height": "25px",
-            "width": "53px"
-          }
-        ],
-        "paddingAll": "0px"
-      }
+            "justifyContent": "center",
+            "paddingAll": "20px"
+        }
     }
-  ]
-}
-"""
\ No newline at end of file
+
+
+def build_carousel(items, page):
+    """Return the carousel dict for a 1-based page of items, or None when the page is empty."""
+    per_page = CAROUSEL_SIZE - 1
+    start = (page - 1) * per_page
+    if start >= len(items) or page < 1:
+        return None
+
+    # 剩下的品項剛好塞得進最後一頁時就不需要翻頁按鈕
+    if len(items) - start <= CAROUSEL_SIZE:
+        return {"type": "carousel", "contents": [item_bubble(x) for x in items[start:]]}
+
+    contents = [item_bubble(x) for x in items[start:start + per_page]]
+    contents.append(more_bubble(page + 1))
+    return {"type": "carousel", "contents": contents}
+
+
+menu_message = TemplateMessage(
+    alt_text='功能表',
+    template=ButtonsTemplate(
+        text='請選擇服務項目',
+        actions=[
+            PostbackAction(
+                label='會員卡',
+                displayText='顯示會員卡',
+                data='action=member_card'
+            ),
+        ]
+    )
+)
+
+_pages = {}
+_pages_version = None
+_lock = threading.Lock()
+
+
+def catalog_message(page=1):
+    """Return the cached FlexMessage for a catalog page, rebuilding it only after the items change."""
+    global _pages, _pages_version
+    items = catalog.get_catalog()
+    with _lock:
+        if _pages_version != items.version:
+            _pages = {}
+            _pages_version = items.version
+        if page not in _pages:
+            carousel = build_carousel(items.items, page)
+            if carousel is None:
+                return None
+            _pages[page] = FlexMessage(
+                alt_text='商品目錄',
+                contents=FlexCarousel.from_dict(carousel)
+            )
+        return _pages[page]
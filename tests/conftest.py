@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 模組在 import 時讀取這些設定，必須先設好
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='linebot-metrics-'))
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test')
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Point db at an empty SQLite file for the duration of one test."""
+    import db
+
+    monkeypatch.setattr(db, 'DATABASE_PATH', str(tmp_path / 'test.db'))
+    db._local.conn = None
+    yield db
+    db.connect().close()
+    db._local.conn = None
+
+
+class StubLine:
+    """benchmarks/stub_line.py served from a background thread, recording every request path and retry key."""
+
+    def __init__(self):
+        self.url = None
+        self.paths = []
+        self.retry_keys = []
+        # 依序取出 (status, headers) 或 (status, headers, body) 回應，取完才交給 stub 處理
+        self.failures = []
+        # 每個請求先等這麼久，模擬逾時
+        self.delay = 0
+
+    def count(self, path):
+        return self.paths.count(path)
+
+
+@pytest.fixture
+def stub_line():
+    import asyncio
+    import threading
+
+    from aiohttp import web
+
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    import stub_line as stub
+
+    server = StubLine()
+
+    @web.middleware
+    async def record(request, handler):
+        server.paths.append(request.path)
+        server.retry_keys.append(request.headers.get('X-Line-Retry-Key'))
+        if server.delay:
+            await asyncio.sleep(server.delay)
+        if server.failures:
+            status, headers, *body = server.failures.pop(0)
+            await request.read()
+            if body:
+                return web.Response(text=body[0], status=status, headers=headers)
+            return web.json_response({"message": "stub failure"}, status=status, headers=headers)
+        return await handler(request)
+
+    app = stub.create_app(0)
+    app.middlewares.append(record)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    server.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
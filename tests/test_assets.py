@@ -0,0 +1,17 @@
+import assets
+
+
+def test_digest_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, 'ASSET_DIGEST_CACHE_SIZE', 3)
+    monkeypatch.setattr(assets, '_digests', {})
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"{i}.png"
+        path.write_bytes(bytes([i]))
+        paths.append(str(path))
+        assert assets.digest(str(path))
+
+    assert list(assets._digests) == paths[2:]
+    # 被擠掉的檔案重新計算後結果一樣
+    assert assets.digest(paths[0]) == assets.digest(paths[0])
+    assert len(assets._digests) == 3
@@ -0,0 +1,155 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import time
+import types
+
+import pytest
+
+import auth
+import metrics
+
+VERIFY_PATH = '/oauth2/v2.1/verify'
+
+
+@pytest.fixture
+def verify_stub(stub_line, monkeypatch):
+    monkeypatch.setattr(auth, 'VERIFY_URL', stub_line.url + VERIFY_PATH)
+    monkeypatch.setattr(auth, '_cache', {})
+    monkeypatch.delenv('LINE_LOGIN_CHANNEL_SECRET', raising=False)
+    monkeypatch.setenv('LINE_CHANNEL_ID', '1234567890')
+    return stub_line
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def hs256_token(secret, claims):
+    header = encode(json.dumps({'alg': 'HS256', 'typ': 'JWT'}).encode())
+    signing_input = f"{header}.{encode(json.dumps(claims).encode())}"
+    signature = hmac.new(secret.encode(), signing_input.encode(), hashlib.sha256).digest()
+    return f"{signing_input}.{encode(signature)}"
+
+
+def test_verified_tokens_are_cached(verify_stub):
+    claims = auth.verify_id_token('token-a')
+    assert claims["aud"] == '1234567890'
+    assert auth.verify_id_token('token-a') == claims
+    assert verify_stub.count(VERIFY_PATH) == 1
+
+    auth.verify_id_token('token-b')
+    assert verify_stub.count(VERIFY_PATH) == 2
+
+
+def test_cached_tokens_expire_at_exp(verify_stub, monkeypatch):
+    claims = auth.verify_id_token('token-a')
+    later = types.SimpleNamespace(time=lambda: claims["exp"] + 1, perf_counter=time.perf_counter)
+    monkeypatch.setattr(auth, 'time', later)
+
+    auth.verify_id_token('token-a')
+    assert verify_stub.count(VERIFY_PATH) == 2
+
+
+def test_rejected_tokens_are_not_cached(verify_stub):
+    for _ in range(2):
+        with pytest.raises(auth.InvalidIdToken):
+            auth.verify_id_token('invalid-token')
+    assert verify_stub.count(VERIFY_PATH) == 2
+    assert auth._cache == {}
+
+
+def test_hs256_tokens_are_verified_locally(verify_stub, monkeypatch):
+    monkeypatch.setenv('LINE_LOGIN_CHANNEL_SECRET', 'login-secret')
+    claims = {"iss": "https://access.line.me", "sub": "U1", "aud": '1234567890', "exp": int(time.time()) + 60}
+    token = hs256_token('login-secret', claims)
+
+    assert auth.verify_id_token(token) == claims
+    assert verify_stub.count(VERIFY_PATH) == 0
+
+    with pytest.raises(auth.InvalidIdToken):
+        auth.verify_id_token(hs256_token('other-secret', claims))
+    with pytest.raises(auth.InvalidIdToken):
+        auth.verify_id_token(hs256_token('login-secret', dict(claims, exp=int(time.time()) - 1)))
+    with pytest.raises(auth.InvalidIdToken):
+        auth.verify_id_token(hs256_token('login-secret', dict(claims, aud='other')))
+
+
+@pytest.mark.parametrize("token", ['W10.e30.sig', 'IjEi.e30.sig', 'not-a-jwt', 'e30.e30', '%%%.e30.sig'])
+def test_malformed_tokens_raise_invalid_id_token(verify_stub, monkeypatch, token):
+    monkeypatch.setenv('LINE_LOGIN_CHANNEL_SECRET', 'login-secret')
+    with pytest.raises(auth.InvalidIdToken):
+        auth.verify_locally(token)
+
+
+def test_hs256_payload_must_be_an_object(verify_stub, monkeypatch):
+    monkeypatch.setenv('LINE_LOGIN_CHANNEL_SECRET', 'login-secret')
+    signing_input = f"{encode(json.dumps({'alg': 'HS256'}).encode())}.{encode(b'[]')}"
+    signature = hmac.new(b'login-secret', signing_input.encode(), hashlib.sha256).digest()
+    with pytest.raises(auth.InvalidIdToken):
+        auth.verify_locally(f"{signing_input}.{encode(signature)}")
+
+
+@pytest.fixture
+def client(database, verify_stub):
+    import app
+
+    return app.create_app().test_client()
+
+
+def test_invalid_token_is_unauthorized(client):
+    assert client.get('/api/points/balance').status_code == 401
+    assert client.get('/api/points/balance', headers={"Authorization": "Bearer invalid-token"}).status_code == 401
+
+
+def test_valid_token_is_authorized(client):
+    response = client.get('/api/points/balance', headers={"Authorization": "Bearer token-a"})
+    assert response.status_code == 200
+    assert response.get_json()["balance"] == 0
+
+
+def async_status(path, headers):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import async_app
+
+    async def get():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            return (await client.get(path, headers=headers)).status
+
+    return asyncio.run(get())
+
+
+def verify_failures():
+    return sum(value for name, _, value in metrics.snapshot()["counters"] if name == 'token_verify_failures_total')
+
+
+@pytest.mark.parametrize("failure", [(503, {}), (200, {}, '<html>busy</html>')])
+def test_verify_api_errors_are_service_unavailable(client, verify_stub, failure):
+    verify_stub.failures = [failure, failure]
+    headers = {"Authorization": "Bearer token-a"}
+    before = verify_failures()
+
+    assert client.get('/api/points/balance', headers=headers).status_code == 503
+    assert async_status('/api/points/balance', headers) == 503
+    assert verify_failures() == before + 2
+    # 暫時性的錯誤不會被快取，恢復後就能通過
+    assert client.get('/api/points/balance', headers=headers).status_code == 200
+
+
+def test_verify_api_timeout_is_service_unavailable(client, verify_stub, monkeypatch):
+    import aiohttp
+
+    import async_app
+
+    monkeypatch.setattr(auth, 'VERIFY_TIMEOUT', (1, 0.1))
+    monkeypatch.setattr(async_app, 'VERIFY_TIMEOUT', aiohttp.ClientTimeout(total=0.1))
+    verify_stub.delay = 0.5
+    headers = {"Authorization": "Bearer token-a"}
+
+    assert client.get('/api/points/balance', headers=headers).status_code == 503
+    assert async_status('/api/points/balance', headers) == 503
+    with pytest.raises(auth.VerifyUnavailable):
+        auth.verify_id_token('token-b')
@@ -0,0 +1,40 @@
+import card
+import storage
+
+
+def table_sum(db):
+    return db.connect().execute('SELECT COALESCE(SUM(size), 0) FROM card_cache').fetchone()[0]
+
+
+def test_total_size_is_kept_with_puts_and_deletes(database):
+    database.put_card_cache('U1', 'a', 100, 1)
+    database.put_card_cache('U2', 'b', 50, 2)
+    database.put_card_cache('U1', 'c', 70, 3)
+    assert database.card_cache_total_size() == table_sum(database) == 120
+
+    database.delete_card_cache('U1')
+    database.delete_card_cache('U3')
+    assert database.card_cache_total_size() == table_sum(database) == 50
+
+
+def test_migration_counts_existing_cards(database):
+    conn = database.connect()
+    conn.execute('DELETE FROM card_cache_size')
+    conn.execute("INSERT INTO card_cache (user_id, key, size, accessed_at) VALUES ('U1', 'a', 30, 1), "
+                 "('U2', 'b', 12, 2)")
+    [migration] = [m for m in database.MIGRATIONS if 'card_cache_size' in m]
+    conn.execute(migration)
+
+    assert database.card_cache_total_size() == 42
+
+
+def test_evict_cards_removes_least_recent_until_under_cap(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'STATIC_DIR', str(tmp_path))
+    for i, uid in enumerate(['U1', 'U2', 'U3']):
+        with open(storage.makedirs(card.card_path(uid)), 'wb') as f:
+            f.write(b'x' * 10)
+        database.put_card_cache(uid, 'k', 10, i)
+
+    assert card.evict_cards(15) == 10
+    assert database.card_cache_total_size() == 10
+    assert [card.card_ready(uid) for uid in ['U1', 'U2', 'U3']] == [False, False, True]
@@ -0,0 +1,99 @@
+import types
+
+import pytest
+import urllib3.util.retry
+from linebot.v3.messaging import ApiException, PushMessageRequest, TextMessage
+
+import line_api
+import metrics
+
+PUSH_PATH = '/v2/bot/message/push'
+
+
+@pytest.fixture
+def messaging_api(stub_line, tmp_path, monkeypatch):
+    monkeypatch.setattr(line_api, 'LINE_API_HOST', stub_line.url)
+    monkeypatch.setattr(line_api, '_client', None)
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+    return line_api.messaging_api()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # 記錄 urllib3 重試前等待的秒數，不真的等
+    slept = []
+    monkeypatch.setattr(urllib3.util.retry, 'time', types.SimpleNamespace(
+        sleep=slept.append, time=urllib3.util.retry.time.time))
+    return slept
+
+
+def push(api):
+    return api.push_message(PushMessageRequest(to='U1', messages=[TextMessage(text='hi')]))
+
+
+def counter(name, **labels):
+    for counter_name, counter_labels, value in metrics.snapshot()["counters"]:
+        if counter_name == name and counter_labels == labels:
+            return value
+    return 0
+
+
+def test_retries_429_and_5xx_with_backoff_and_retry_after(messaging_api, stub_line, sleeps):
+    stub_line.failures = [(503, {}), (502, {}), (429, {"Retry-After": "2"})]
+
+    assert push(messaging_api).sent_messages
+    assert stub_line.count(PUSH_PATH) == 4
+    # 第一次失敗立刻重試，第二次退避 0.5 * 2 秒，429 依照 Retry-After
+    assert sleeps == [1.0, 2]
+    assert counter('line_api_requests_total', method='push_message', status='200') == 1
+
+
+def test_gives_up_after_three_retries(messaging_api, stub_line, sleeps):
+    stub_line.failures = [(500, {})] * 5
+
+    with pytest.raises(ApiException) as e:
+        push(messaging_api)
+    assert e.value.status == 500
+    assert stub_line.count(PUSH_PATH) == 4
+    assert counter('line_api_requests_total', method='push_message', status='500') == 1
+
+
+def test_client_errors_are_not_retried(messaging_api, stub_line, sleeps):
+    stub_line.failures = [(400, {})]
+
+    with pytest.raises(ApiException):
+        push(messaging_api)
+    assert stub_line.count(PUSH_PATH) == 1
+    assert sleeps == []
+
+
+def test_counts_requests_per_method(messaging_api, stub_line):
+    push(messaging_api)
+    push(messaging_api)
+    messaging_api.get_message_quota()
+    messaging_api.get_message_quota_with_http_info()
+
+    assert counter('line_api_requests_total', method='push_message', status='200') == 2
+    assert counter('line_api_requests_total', method='get_message_quota', status='200') == 2
+    histograms = {(name, labels.get('method')): h for name, labels, h in metrics.snapshot()["histograms"]}
+    assert histograms[('line_api_seconds', 'push_message')]["count"] == 2
+
+
+class RecordingApi:
+    def __init__(self):
+        self.calls = []
+
+    def push_message(self, *args, **kwargs):
+        self.calls.append(kwargs)
+
+
+def test_sets_default_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    recording = RecordingApi()
+    api = line_api.InstrumentedApi(recording)
+
+    api.push_message('request')
+    api.push_message('request', _request_timeout=1)
+    assert recording.calls == [{"_request_timeout": line_api.LINE_API_TIMEOUT}, {"_request_timeout": 1}]
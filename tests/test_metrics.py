@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+    return tmp_path
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_snapshot(path, value):
+    path.write_text(json.dumps({"counters": [["requests_total", {"method": "GET"}, value]], "histograms": [
+        ["request_seconds", {}, {"bounds": [0.1, 1.0], "buckets": [value, value], "sum": 0.5, "count": value}],
+    ]}))
+
+
+def test_aggregate_folds_exited_processes_into_archive(metrics_dir):
+    write_snapshot(metrics_dir / f"{exited_pid()}-deadbeef.json", 2)
+    # 同一個 pid 之前的 process 留下的檔案
+    write_snapshot(metrics_dir / f"{os.getpid()}-0badc0de.json", 3)
+    metrics.inc('requests_total', method='GET')
+
+    counters, histograms = metrics.aggregate()
+    assert counters[('requests_total', (('method', 'GET'),))] == 6
+    assert histograms[('request_seconds', ())]["count"] == 5
+    assert sorted(os.listdir(metrics_dir)) == ['.lock', metrics.ARCHIVE_NAME]
+
+    # 再加總一次不會重複計算
+    counters, histograms = metrics.aggregate()
+    assert counters[('requests_total', (('method', 'GET'),))] == 6
+    assert histograms[('request_seconds', ())]["buckets"] == [5, 5]
+
+
+def test_aggregate_keeps_live_processes(metrics_dir):
+    live = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        write_snapshot(metrics_dir / f"{live.pid}-deadbeef.json", 4)
+        counters, _ = metrics.aggregate()
+        assert counters[('requests_total', (('method', 'GET'),))] == 4
+        assert (metrics_dir / f"{live.pid}-deadbeef.json").exists()
+    finally:
+        live.kill()
+        live.wait()
@@ -0,0 +1,101 @@
+import time
+import types
+
+import pytest
+import urllib3.util.retry
+from linebot.v3.messaging import TextMessage
+
+import line_api
+import notify
+
+PUSH_PATH = '/v2/bot/message/push'
+NARROWCAST_PATH = '/v2/bot/message/narrowcast'
+
+
+@pytest.fixture
+def notifier(stub_line, database, tmp_path, monkeypatch):
+    monkeypatch.setattr(line_api, 'LINE_API_HOST', stub_line.url)
+    monkeypatch.setattr(line_api, '_client', None)
+    # 不真的等 urllib3 的退避
+    monkeypatch.setattr(urllib3.util.retry, 'time', types.SimpleNamespace(
+        sleep=lambda seconds: None, time=urllib3.util.retry.time.time))
+    notifier = notify.Notifier(rate=1000)
+    # 額度查詢會用掉注入的失敗回應，先當作剛查過、沒有上限
+    notifier.quota.refreshed = time.time()
+    return notifier
+
+
+def statuses(db):
+    return [row[0] for row in db.connect().execute('SELECT status FROM notifications ORDER BY seq')]
+
+
+def make_due(db):
+    db.connect().execute('UPDATE notifications SET next_attempt_at = 0')
+
+
+def test_retries_reuse_the_first_retry_key(notifier, stub_line, database):
+    notify.enqueue('U1', [TextMessage(text='+10 點')])
+    notify.enqueue('U1', [TextMessage(text='+5 點')])
+    stub_line.failures = [(503, {})] * 4
+
+    assert notifier.run_once() == 2
+    assert statuses(database) == ['pending', 'pending']
+    first_key = stub_line.retry_keys[0]
+    assert first_key and set(stub_line.retry_keys) == {first_key}
+
+    # 新的通知不能混進重送的那一批
+    notify.enqueue('U1', [TextMessage(text='+1 點')])
+    make_due(database)
+    assert notifier.run_once() == 3
+    assert statuses(database) == ['sent', 'sent', 'sent']
+    assert stub_line.count(PUSH_PATH) == 6
+    assert stub_line.retry_keys[4] == first_key
+    assert stub_line.retry_keys[5] != first_key
+
+
+def test_conflict_on_a_retry_means_already_sent(notifier, stub_line, database):
+    notify.enqueue('U1', [TextMessage(text='+10 點')])
+    stub_line.failures = [(500, {})] * 4
+    notifier.run_once()
+
+    make_due(database)
+    stub_line.failures = [(409, {})]
+    notifier.run_once()
+    assert statuses(database) == ['sent']
+
+
+def test_retried_batches_are_loaded_whole(database):
+    for user_id in ('U1', 'U2', 'U3'):
+        database.enqueue_notification(user_id, [{"type": "text", "text": "hi"}])
+    seqs = [row["seq"] for row in database.due_notifications(1e12, 10)]
+    database.reschedule_notifications(seqs, '503', 0, 'key-1')
+
+    rows = database.due_notifications(1e12, 1)
+    assert [row["seq"] for row in rows] == seqs
+    assert notify.replan(rows) == [("multicast", ['U1', 'U2', 'U3'], [{"type": "text", "text": "hi"}], seqs, 'key-1')]
+
+
+class LimitedQuota:
+    def get_message_quota(self):
+        return types.SimpleNamespace(type='limited', value=1000)
+
+    def get_message_quota_consumption(self):
+        return types.SimpleNamespace(total_usage=500)
+
+
+def test_broadcast_respects_the_quota(notifier, stub_line, database):
+    # stub 回報 1000 個可觸及的好友，本月只剩 500 則
+    notifier.quota.api = LimitedQuota()
+    notifier.quota.refreshed = 0
+    notify.broadcast([TextMessage(text='新品上市')])
+
+    notifier.run_once()
+    assert stub_line.count(NARROWCAST_PATH) == 0
+    assert stub_line.count('/v2/bot/insight/followers') == 1
+    assert statuses(database) == ['pending']
+
+    notifier.quota.audience = 400
+    notifier.quota.refreshed = 0
+    notifier.run_once()
+    assert stub_line.count(NARROWCAST_PATH) == 1
+    assert statuses(database) == ['sent']
@@ -0,0 +1,63 @@
+import io
+
+import pytest
+
+import orders
+
+
+def test_normalize_items_accepts_integral_quantities():
+    catalog_items = {"i1": {"id": "i1", "price": 60}}
+    assert orders.normalize_items([{"id": "i1", "qty": "2"}, {"id": "i1", "qty": 3.0}], catalog_items) == [
+        {"id": "i1", "qty": 2}, {"id": "i1", "qty": 3}]
+
+
+@pytest.mark.parametrize("qty", [1.7, "1.7", 0, -1, None, "abc"])
+def test_normalize_items_rejects_bad_quantities(qty):
+    with pytest.raises(orders.InvalidOrder):
+        orders.normalize_items([{"id": "i1", "qty": qty}], {"i1": {"id": "i1", "price": 60}})
+
+
+def test_order_total_rejects_non_numeric_catalog_price():
+    with pytest.raises(orders.InvalidOrder):
+        orders.order_total([{"id": "i1", "qty": 1}], {"i1": {"id": "i1", "price": "free"}})
+
+
+@pytest.fixture
+def client(database):
+    import app
+
+    return app.create_app().test_client()
+
+
+@pytest.mark.parametrize("path", ['/api/admin/orders', '/api/admin/orders/bulk'])
+def test_order_endpoints_reject_non_object_bodies(client, path):
+    assert client.post(path, json=[{"userId": "U1"}]).status_code == 400
+
+
+def test_item_create_rejects_non_numeric_price(client, database):
+    response = client.post('/admin/items', data={
+        "name": "拿鐵",
+        "price": "sixty",
+        "image": (io.BytesIO(b""), "latte.jpg"),
+    })
+    assert response.status_code == 400
+    assert database.list_items() == []
+
+
+def test_bulk_orders_reject_non_object_entries(client, database):
+    database.create_item({"id": "i1", "name": "拿鐵", "image": "", "price": 60})
+    response = client.post('/api/admin/orders/bulk', json={"orders": [{"userId": "U1", "items": [
+        {"id": "i1", "qty": 1}]}, "U2"]})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "order 1: not an object"}
+
+
+@pytest.mark.parametrize("query", ['limit=abc', 'cursor=x', 'limit=1.5'])
+def test_order_list_rejects_bad_paging_args(client, query):
+    assert client.get(f'/api/admin/orders?{query}').status_code == 400
+
+
+def test_order_list_accepts_paging_args(client):
+    response = client.get('/api/admin/orders?limit=10&cursor=5')
+    assert response.status_code == 200
+    assert response.get_json()["orders"] == []
@@ -0,0 +1,83 @@
+import asyncio
+import os
+from concurrent.futures import Future
+
+import pytest
+
+import auth
+import card
+import storage
+
+
+@pytest.fixture
+def verify_stub(stub_line, monkeypatch):
+    monkeypatch.setattr(auth, 'VERIFY_URL', stub_line.url + '/oauth2/v2.1/verify')
+    monkeypatch.setattr(auth, '_cache', {})
+    monkeypatch.delenv('LINE_LOGIN_CHANNEL_SECRET', raising=False)
+    return stub_line
+
+
+@pytest.fixture
+def renders(tmp_path, monkeypatch):
+    """Replace the card renderer with one that writes placeholder files and records the members."""
+    monkeypatch.setattr(storage, 'STATIC_DIR', str(tmp_path))
+    rendered = []
+
+    def ensure_card(name, uid):
+        rendered.append(uid)
+        for path in card.card_files(uid):
+            with open(storage.makedirs(path), 'wb') as f:
+                f.write(b'card')
+        future = Future()
+        future.set_result(None)
+        return future
+
+    monkeypatch.setattr(card, 'ensure_card', ensure_card)
+    return rendered
+
+
+def flask_get(headers):
+    import app
+
+    response = app.create_app().test_client().get('/api/profile', headers=headers)
+    return response.status_code, response.get_json()
+
+
+def async_get(headers):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import async_app
+
+    async def get():
+        async with TestClient(TestServer(async_app.create_app())) as client:
+            response = await client.get('/api/profile', headers=headers)
+            return response.status, await response.json() if response.status == 200 else None
+
+    return asyncio.run(get())
+
+
+@pytest.mark.parametrize("get", [flask_get, async_get])
+def test_profile_api(verify_stub, database, renders, get):
+    status, profile = get({"Authorization": "Bearer token-a"})
+    assert status == 200
+    assert profile["user_id"].startswith("U")
+    assert '/static/avatar/default.png' in profile["avatar_url"]
+    assert '_qr.png?v=' in profile["qr_url"]
+
+    assert get({"Authorization": "Bearer invalid-token"})[0] == 401
+    assert get({})[0] == 401
+
+
+@pytest.mark.parametrize("get", [flask_get, async_get])
+def test_profile_api_renders_evicted_cards_again(verify_stub, database, renders, get):
+    uid = get({"Authorization": "Bearer token-a"})[1]["user_id"]
+    get({"Authorization": "Bearer token-a"})
+    assert renders == [uid]
+
+    # 快取淘汰會刪掉會員卡、QR code 與條碼
+    for path in card.card_files(uid):
+        os.remove(path)
+    status, profile = get({"Authorization": "Bearer token-a"})
+    assert status == 200
+    assert renders == [uid, uid]
+    assert profile["card_url"] and profile["qr_url"] and profile["barcode_url"]
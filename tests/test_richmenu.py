@@ -0,0 +1,71 @@
+import io
+
+import pytest
+from linebot.v3.messaging import RichMenuBulkLinkRequest
+
+import line_api
+import richmenu
+
+
+@pytest.fixture
+def api(stub_line, tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setattr(line_api, 'LINE_API_HOST', stub_line.url)
+    monkeypatch.setattr(line_api, 'LINE_API_DATA_HOST', stub_line.url)
+    monkeypatch.setattr(line_api, '_client', None)
+    monkeypatch.setattr(richmenu, 'STAFF_USER_IDS', ['Ustaff1', 'Ustaff2'])
+    image = tmp_path / 'menu.png'
+    Image.new('RGB', (2500, 1686), (200, 100, 50)).save(image)
+    for segment in richmenu.MENUS:
+        monkeypatch.setitem(richmenu.MENUS, segment, dict(richmenu.MENUS[segment], image=str(image)))
+    return line_api.messaging_api()
+
+
+def deploy_all(api):
+    blob_api = line_api.messaging_api_blob()
+    return {segment: richmenu.deploy(segment, api, blob_api) for segment in richmenu.MENUS}
+
+
+def user_menu(api, uid):
+    return api.get_rich_menu_id_of_user(uid).rich_menu_id
+
+
+def test_deploy_relinks_staff_before_gc(api, monkeypatch):
+    first = deploy_all(api)
+    richmenu.link('staff', api, richmenu.segment_user_ids('staff'))
+    assert user_menu(api, 'Ustaff1') == first['staff']
+
+    monkeypatch.setattr(richmenu, 'ADMIN_URL', 'https://example.com/admin')
+    second = deploy_all(api)
+    assert second['member'] == first['member']
+    assert second['staff'] != first['staff']
+    assert user_menu(api, 'Ustaff1') == second['staff']
+
+    assert richmenu.collect_garbage(api) == [first['staff']]
+    assert {menu.rich_menu_id for menu in api.get_rich_menu_list().richmenus} == set(second.values())
+
+
+def test_gc_skips_menus_still_linked_to_users(api, monkeypatch, capsys):
+    first = deploy_all(api)
+    monkeypatch.setattr(richmenu, 'ADMIN_URL', 'https://example.com/admin')
+    deploy_all(api)
+    # 有人在 deploy 之後又手動綁回舊選單
+    api.link_rich_menu_id_to_users(RichMenuBulkLinkRequest(rich_menu_id=first['staff'], user_ids=['Ustaff2']))
+
+    assert richmenu.collect_garbage(api) == []
+    assert 'still linked to 1 users' in capsys.readouterr().err
+    assert first['staff'] in {menu.rich_menu_id for menu in api.get_rich_menu_list().richmenus}
+
+
+def test_prepare_image_flattens_transparency():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGBA', (100, 50), (0, 0, 0, 0)).save(buffer, format='PNG')
+    data, content_type = richmenu.prepare_image(buffer.getvalue(), 200, 100)
+
+    img = Image.open(io.BytesIO(data))
+    assert content_type == 'image/png'
+    assert img.mode == 'RGB' and img.size == (200, 100)
+    assert img.getpixel((0, 0)) == (255, 255, 255)
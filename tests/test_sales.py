@@ -0,0 +1,83 @@
+import datetime
+import json
+
+
+def write_legacy(static_dir, orders, points):
+    files = {
+        'users.json': [{"id": "U1", "name": "小明"}],
+        'item.json': [{"id": "i1", "name": "拿鐵", "image": "", "price": 60}],
+        'order.json': orders,
+        'point.json': points,
+    }
+    for name, data in files.items():
+        (static_dir / name).write_text(json.dumps(data, ensure_ascii=False))
+
+
+def test_migrate_json_rolls_up_string_quantities(database, tmp_path):
+    write_legacy(
+        tmp_path,
+        [{"id": "o1", "user_id": "U1", "items": [{"id": "i1", "qty": "2"}], "total": 120}],
+        [{"id": "p1", "user_id": "U1", "description": "", "order_id": "o1", "point": 12,
+          "created_at": "2023-11-01T10:00:00"}],
+    )
+
+    database.migrate_json(str(tmp_path))
+
+    assert database.sales_daily() == [{"day": "2023-11-01", "orders": 1, "quantity": 2, "revenue": 120, "points": 12}]
+    assert database.sales_items() == [{"id": "i1", "orders": 1, "quantity": 2, "revenue": 120}]
+
+
+def test_rebuild_sales_matches_incremental_rollups(database):
+    database.create_item({"id": "i1", "name": "拿鐵", "image": "", "price": 60})
+    order = {"id": "o1", "user_id": "U1", "items": [{"id": "i1", "qty": "3"}], "total": 180,
+             "created_at": "2023-11-02T09:00:00"}
+    point = {"id": "p1", "user_id": "U1", "description": "", "order_id": "o1", "point": 18,
+             "created_at": order["created_at"]}
+    database.create_orders([(order, point, None)])
+    incremental = (database.sales_daily(), database.sales_items(), database.sales_members(10))
+
+    assert database.rebuild_sales() == 1
+    assert (database.sales_daily(), database.sales_items(), database.sales_members(10)) == incremental
+    assert incremental[1] == [{"id": "i1", "orders": 1, "quantity": 3, "revenue": 180}]
+
+
+def test_migrate_json_stores_integer_quantities_and_prices(database, tmp_path):
+    write_legacy(
+        tmp_path,
+        [{"id": "o1", "user_id": "U1", "items": [{"id": "i1", "qty": "2"}], "total": "120"}],
+        [],
+    )
+    (tmp_path / 'item.json').write_text(json.dumps([{"id": "i1", "name": "拿鐵", "image": "", "price": "60"}]))
+
+    database.migrate_json(str(tmp_path))
+
+    (order,) = database.iter_orders()
+    assert order["items"] == [{"id": "i1", "qty": 2}]
+    assert order["total"] == 120
+    assert database.list_items()[0]["price"] == 60
+
+
+class EarlyMorningInTaipei(datetime.datetime):
+    """2023-11-01 23:30 UTC, which is already 2023-11-02 in UTC+8."""
+
+    @classmethod
+    def now(cls, tz=None):
+        utc = datetime.datetime(2023, 11, 1, 23, 30, tzinfo=datetime.timezone.utc)
+        return utc.astimezone(tz) if tz else utc.replace(tzinfo=None)
+
+
+def test_orders_are_counted_on_the_business_day(database, monkeypatch):
+    import app
+    import orders
+
+    monkeypatch.setattr(orders, 'BUSINESS_TIMEZONE', datetime.timezone(datetime.timedelta(hours=8)))
+    monkeypatch.setattr(orders, 'datetime', EarlyMorningInTaipei)
+    database.create_item({"id": "i1", "name": "拿鐵", "image": "", "price": 60})
+    order = orders.create_order("U1", [{"id": "i1", "qty": 1}])
+    assert order["created_at"].endswith('+08:00')
+
+    response = app.create_app().test_client().get('/api/admin/sales/daily?from=2023-11-01')
+    assert response.get_json() == {
+        "today": "2023-11-02",
+        "days": [{"day": "2023-11-02", "orders": 1, "quantity": 1, "revenue": 60, "points": 6}],
+    }
@@ -0,0 +1,56 @@
+import contextvars
+import json
+import logging
+import os
+import time
+import uuid
+
+# LOG_FORMAT=json 時輸出一行一筆的 JSON log，方便依 trace_id 串起同一個請求
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+
+
+def start(trace_id=None):
+    """Set the trace id of the current request / event, generating one when none is given."""
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current():
+    return _trace_id.get()
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = _trace_id.get() or '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "trace_id": getattr(record, 'trace_id', None),
+            "pid": record.process,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceIdFilter())
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
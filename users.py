@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+import db
+import metrics
+
+# 每個 worker 最多記住這麼多會員，超過時先丟掉最早載入的
+USER_DIRECTORY_MAX = int(os.environ.get('USER_DIRECTORY_MAX', 100000))
+# 其他 worker 改名後，最多隔這麼久才會看到
+USER_DIRECTORY_RECHECK = float(os.environ.get('USER_DIRECTORY_RECHECK', 1))
+
+
+class User:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class Directory:
+    """Members this process has looked up, keyed by LINE user id and synced through the users version."""
+
+    def __init__(self):
+        self.users = {}
+        self.version = db.get_version('users')
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _store(self, row):
+        user = self.users[row["id"]] = User(row["id"], row["name"])
+        if len(self.users) > USER_DIRECTORY_MAX:
+            self.users.pop(next(iter(self.users)))
+        return user
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self.checked < USER_DIRECTORY_RECHECK:
+            return
+        self.checked = now
+        version = db.get_version('users')
+        if version == self.version:
+            return
+        # 只更新已經載入的會員，其餘的等用到時再查
+        for row in db.users_changed_since(self.version):
+            if row["id"] in self.users:
+                self._store(row)
+        self.version = version
+
+    def get(self, user_id):
+        with self.lock:
+            self._sync()
+            user = self.users.get(user_id)
+        if user is not None:
+            metrics.inc('user_directory_lookups_total', result='hit')
+            return user
+
+        metrics.inc('user_directory_lookups_total', result='miss')
+        row = db.get_user(user_id)
+        if row is None:
+            return None
+        with self.lock:
+            return self._store(row)
+
+    def get_or_create(self, user_id, name, rename=False):
+        user = self.get(user_id)
+        if user is not None and (not rename or user.name == name):
+            return user
+        # 寫入資料庫後直接更新本 process 的資料，不必等下次同步
+        row = db.get_or_create_user(user_id, name, rename=rename)
+        with self.lock:
+            return self._store(row)
+
+
+_directory = None
+_directory_pid = None
+_lock = threading.Lock()
+
+
+def directory():
+    global _directory, _directory_pid
+    with _lock:
+        if _directory is None or _directory_pid != os.getpid():
+            _directory = Directory()
+            _directory_pid = os.getpid()
+        return _directory
+
+
+def get(user_id):
+    return directory().get(user_id)
+
+
+def get_or_create(user_id, name):
+    """Return the member, registering it under name when it is new."""
+    return directory().get_or_create(user_id, name)
+
+
+def sync_name(user_id, name):
+    """Register the member or store the name from its LINE profile when it changed."""
+    return directory().get_or_create(user_id, name, rename=True)
@@ -0,0 +1,89 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+import db
+import metrics
+import tracing
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 256))
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """WebhookHandler that verifies and enqueues events, running the handlers on background threads."""
+
+    def __init__(self, channel_secret, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        super().__init__(channel_secret)
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_queue(self):
+        # uwsgi fork 出 worker 之後才啟動 thread
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._pid = os.getpid()
+                for _ in range(self.workers):
+                    threading.Thread(target=self._work, args=(self._queue,), daemon=True).start()
+            return self._queue
+
+    def handle(self, body, signature):
+        """Verify the signature and queue new events; raises queue.Full when the workers are saturated."""
+        payload = self.parser.parse(body, signature, as_payload=True)
+        events_queue = self._get_queue()
+
+        # 先確認排得進去再標記為已處理，否則 LINE 重送時會被當成重複事件丟掉
+        if events_queue.maxsize - events_queue.qsize() < len(payload.events):
+            metrics.inc('webhook_rejected_total')
+            raise queue.Full
+
+        queued = 0
+        for event in payload.events:
+            if not db.mark_webhook_event(event.webhook_event_id):
+                metrics.inc('webhook_duplicates_total', redelivery=str(event.delivery_context.is_redelivery).lower())
+                continue
+            try:
+                events_queue.put_nowait((event, payload.destination, tracing.current()))
+            except queue.Full:
+                db.forget_webhook_event(event.webhook_event_id)
+                metrics.inc('webhook_rejected_total')
+                raise
+            queued += 1
+        return queued
+
+    def dispatch(self, event, destination):
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+        if func is None:
+            func = self._handlers.get(type(event).__name__, self._default)
+        if func is None:
+            logger.info('No handler of %s and no default handler', type(event).__name__)
+            return
+        func(event)
+
+    def _work(self, events_queue):
+        while True:
+            event, destination, trace_id = events_queue.get()
+            tracing.start(trace_id)
+            start = time.perf_counter()
+            try:
+                self.dispatch(event, destination)
+            except Exception:
+                logger.exception('Failed to handle webhook event %s', event.webhook_event_id)
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.observe('webhook_event_seconds', elapsed, type=event.type)
+                logger.debug('Handled %s event %s in %.3fs', event.type, event.webhook_event_id, elapsed)
+                events_queue.task_done()
@@ -0,0 +1,6 @@
+# uwsgi 的進入點。lazy-apps 關閉時 master 只載入一次，先把 app 建好並預載重量級模組與會員卡素材，
+# fork 出來的 worker 以 copy-on-write 共用這些記憶體，不必各自 import
+from app import create_app, preload
+
+app = create_app()
+preload()